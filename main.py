@@ -4,11 +4,13 @@ Runs the specified pipeline for the example Ray QuickStart project using the def
 """
 import sys
 
+from benchmark.suite import run_benchmarks
+from data.prepare_dataset import prepare_dataset
 from data.storage_manager import StorageManager
 from log import log
 from models.gpt2 import GPT2
 from training.gpt2_trainer_initializer import GPT2TrainerInitializer
-from training.trainer import train, tune_hyperparameters
+from training.trainer import find_batch_size, train, tune_hyperparameters
 
 sys.path.insert(0, 'src')
 
@@ -17,9 +19,31 @@ from enum import Enum, auto
 
 
 class Action(Enum):
+    PREPARE_DATA = auto()  # tokenize the raw Shakespeare corpus into train.bin, val.bin and meta.pkl
+    FIND_BATCH_SIZE = auto()  # find the batch size with the highest training throughput
     TRAIN_MODEL = auto()  # train the model
     TUNE_MODEL_HYPERPARAMETERS = auto()  # tune hyperparameters for model
     GENERATE_TEXT = auto()  # generate text using the model
+    BENCHMARK = auto()  # measure the throughput of each stage of the training pipeline with a tiny GPT2 model
+
+
+def prepare_data(storage_manager):
+    log.info('preparing Shakespeare corpus for GPT2 model...')
+    data_dir = f'{storage_manager.get_data_dir()}/shakespeare_char'
+    prepare_dataset(f'{data_dir}/raw.txt', data_dir, tokenizer='char')
+
+
+def find_batch_size_for_model(storage_manager):
+    log.info('finding best batch size for GPT2 model trained on Shakespeare corpus...')
+    model = GPT2(storage_manager, 'shakespeare_char', 'text-generation')
+    find_batch_size(GPT2TrainerInitializer(storage_manager, model, None))
+
+
+def benchmark_pipeline(update_baseline=False):
+    log.info('benchmarking training pipeline with tiny GPT2 model...')
+    _, regressions = run_benchmarks(update_baseline=update_baseline)
+    if len(regressions) > 0 and not update_baseline:
+        sys.exit(1)
 
 
 def train_model(storage_manager):
@@ -36,20 +60,28 @@ def tune_model_hyperparameters(storage_manager):
     tune_hyperparameters(GPT2TrainerInitializer(storage_manager, model, None))
 
 
-def main(pipeline):
+def main(pipeline, update_baseline=False):
     storage_manager = StorageManager()
 
     log.info(f'running pipeline: {[action.name for action in pipeline]}')
     for action in pipeline:
+        if action == Action.PREPARE_DATA:
+            prepare_data(storage_manager)
+        if action == Action.FIND_BATCH_SIZE:
+            find_batch_size_for_model(storage_manager)
         if action == Action.TRAIN_MODEL:
             train_model(storage_manager)
         if action == Action.TUNE_MODEL_HYPERPARAMETERS:
             tune_model_hyperparameters(storage_manager)
+        if action == Action.BENCHMARK:
+            benchmark_pipeline(update_baseline)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--action', type=str, required=False, help='action to perform')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='accept the results of the BENCHMARK action as the new baseline')
     opt = parser.parse_args()
 
     if opt.action is not None:
@@ -58,4 +90,4 @@ if __name__ == '__main__':
         # DIRECTION: change this to modify the action taken
         pipeline = [Action.TRAIN_MODEL]
 
-    main(pipeline)
+    main(pipeline, opt.update_baseline)
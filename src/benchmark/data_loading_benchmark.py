@@ -0,0 +1,110 @@
+"""
+Measures how many training examples per second can be loaded from a dataset on the CPU.
+"""
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from data.gpt2_data_collator import GPT2DataCollator
+from log import log
+
+
+def benchmark_gpt2_batch_access(dataset, batch_size=64, num_batches=100, seed=0):
+    """
+    Compare loading batches of GPT2Dataset one example at a time (the previous behavior) with loading them through
+    GPT2Dataset.__getitems__(), both collated by GPT2DataCollator.
+
+    :return: a dict with the samples per second of 'per_example' and 'batched' access.
+    """
+    rng = np.random.default_rng(seed)
+    batches = [rng.integers(0, len(dataset), size=batch_size).tolist() for _ in range(num_batches)]
+    collator = GPT2DataCollator()
+
+    def load_per_example(indices):
+        return collator([dataset[index] for index in indices])
+
+    def load_batched(indices):
+        return collator(dataset.__getitems__(indices))
+
+    samples_per_sec = {}
+    for name, load_batch in (('per_example', load_per_example), ('batched', load_batched)):
+        load_batch(batches[0])  # warm up the page cache before timing
+        start_time = time.perf_counter()
+        for indices in batches:
+            load_batch(indices)
+        samples_per_sec[name] = batch_size * num_batches / (time.perf_counter() - start_time)
+    log.info(f'GPT2 batch loading: {samples_per_sec["per_example"]:.0f} samples/s per example, '
+             f'{samples_per_sec["batched"]:.0f} samples/s batched '
+             f'({samples_per_sec["batched"] / samples_per_sec["per_example"]:.1f}x)')
+    return samples_per_sec
+
+
+def benchmark_dataloader_prefetch(dataset, collate_fn, model, batch_size=64, num_steps=50, settings=None):
+    """
+    Measure the average time of a training step of model (forward and backward passes on the CPU) when its batches are
+    loaded by DataLoaders with different settings. Without workers, the loading of each batch adds to the step time;
+    with prefetching workers, it overlaps with the previous steps, which compete with the workers for the CPU like they
+    do in training.
+
+    :param model: The HuggingFace language model to train on the batches. Its gradients are computed but not applied.
+    :param settings: A dict of names to DataLoader keyword arguments. Defaults to no workers vs 2 prefetching workers.
+    :return: a dict with the average seconds per step for each of the settings.
+    """
+    if settings is None:
+        settings = {'no_prefetch': {'num_workers': 0},
+                    'prefetch': {'num_workers': 2, 'prefetch_factor': 2, 'persistent_workers': True}}
+    model.train()
+    step_times = {}
+    for name, dataloader_kwargs in settings.items():
+        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, collate_fn=collate_fn,
+                                **dataloader_kwargs)
+        batches = iter(dataloader)
+        _train_step(model, next(batches))  # start the workers and warm up the model before timing
+        compute_time = 0.0
+        start_time = time.perf_counter()
+        for _ in range(num_steps):
+            batch = next(batches)
+            compute_start_time = time.perf_counter()
+            _train_step(model, batch)
+            compute_time += time.perf_counter() - compute_start_time
+        step_times[name] = (time.perf_counter() - start_time) / num_steps
+        log.info(f'{name}: {step_times[name] * 1000:.1f} ms per step '
+                 f'({(step_times[name] - compute_time / num_steps) * 1000:.1f} ms waiting for data)')
+    model.zero_grad(set_to_none=True)
+    return step_times
+
+
+def _train_step(model, batch):
+    # the batches hold the input ids in a compact dtype (see GPT2DataCollator): widen them like GPT2.forward() does
+    loss = model(input_ids=batch['input_ids'].long(), labels=batch['labels'].long()).loss
+    loss.backward()
+
+
+def benchmark_token_dtype(dataset, vocab_size, batch_size=64, num_batches=100, device=None, seed=0):
+    """
+    Compare batches widened to int64 on the host (the previous behavior) with batches whose input ids are kept in the
+    compact token dtype and widened on the device, from collating the examples to having int64 tensors on the device.
+
+    :return: a dict with the 'bytes_per_batch' and 'samples_per_sec' of 'int64' and 'compact' batches.
+    """
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    rng = np.random.default_rng(seed)
+    batches = [rng.integers(0, len(dataset), size=batch_size).tolist() for _ in range(num_batches)]
+    results = {}
+    for name, collator in (('int64', GPT2DataCollator()), ('compact', GPT2DataCollator(vocab_size))):
+        bytes_per_batch = 0
+        start_time = time.perf_counter()
+        for indices in batches:
+            batch = collator(dataset.__getitems__(indices))
+            bytes_per_batch = sum(tensor.element_size() * tensor.nelement() for tensor in batch.values())
+            batch = {key: tensor.to(device, non_blocking=True).long() for key, tensor in batch.items()}
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        results[name] = {'bytes_per_batch': bytes_per_batch,
+                         'samples_per_sec': batch_size * num_batches / (time.perf_counter() - start_time)}
+    for name, result in results.items():
+        log.info(f'{name} batches: {result["bytes_per_batch"] / 1e6:.2f} MB, {result["samples_per_sec"]:.0f} samples/s')
+    return results
@@ -0,0 +1,64 @@
+"""
+Compares the vectorized stratified splitter with the per-example implementation it replaced.
+"""
+import time
+
+import numpy as np
+
+from data.dataset_util import split_dataset_for_classification, split_dataset_random
+from log import log
+
+
+def split_dataset_for_classification_per_example(dataset, split_ratio):
+    """the previous implementation of split_dataset_for_classification(), which copies the examples into lists"""
+    examples_for_classes_in_dataset = {}
+    for example in dataset:
+        label = example['label']
+        if label not in examples_for_classes_in_dataset:
+            examples_for_classes_in_dataset[label] = []
+        examples_for_classes_in_dataset[label].append(example)
+    train_dataset = []
+    eval_dataset = []
+    for example_class in examples_for_classes_in_dataset.keys():
+        examples = examples_for_classes_in_dataset[example_class]
+        num_examples = len(examples)
+        if num_examples == 1:
+            train_dataset.append(examples[0])
+        elif num_examples == 2:
+            train_dataset.append(examples[0])
+            eval_dataset.append(examples[1])
+        else:
+            train_examples, test_examples = split_dataset_random(examples, split_ratio)
+            train_dataset.extend(train_examples)
+            eval_dataset.extend(test_examples)
+    return train_dataset, eval_dataset
+
+
+def create_labelled_dataset(num_examples=100000, num_classes=20, seed=0):
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, num_classes, size=num_examples)
+    return [{'id': index, 'label': int(label)} for index, label in enumerate(labels)]
+
+
+def benchmark_stratified_split(dataset=None, split_ratio=0.9):
+    """
+    Time both splitters on dataset (a synthetic labelled dataset by default) and check that they produce the same
+    splits.
+
+    :return: a dict with the seconds taken by 'per_example' and 'vectorized'.
+    """
+    if dataset is None:
+        dataset = create_labelled_dataset()
+    timings = {}
+    splits = {}
+    for name, split in (('per_example', split_dataset_for_classification_per_example),
+                        ('vectorized', split_dataset_for_classification)):
+        start_time = time.perf_counter()
+        splits[name] = split(dataset, split_ratio)
+        timings[name] = time.perf_counter() - start_time
+    for expected, actual in zip(splits['per_example'], splits['vectorized']):
+        if list(expected) != [dataset[index] for index in actual.indices]:
+            raise AssertionError('the vectorized split does not match the per-example split')
+    log.info(f'stratified split of {len(dataset)} examples: {timings["per_example"]:.3f}s per example, '
+             f'{timings["vectorized"]:.3f}s vectorized ({timings["per_example"] / timings["vectorized"]:.1f}x)')
+    return timings
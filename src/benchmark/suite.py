@@ -0,0 +1,350 @@
+"""
+End-to-end throughput benchmark of the training pipeline, runnable on a CPU-only machine with a tiny GPT2 model.
+
+Each stage of the pipeline is measured separately and the results are written as JSON. When a baseline JSON file is
+given, every metric is compared with it and the ones that got worse by more than the tolerance are flagged as
+regressions.
+"""
+import json
+import os
+import platform as python_platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import ray
+import torch
+import transformers
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from benchmark.data_loading_benchmark import benchmark_dataloader_prefetch, benchmark_gpt2_batch_access, \
+    benchmark_token_dtype
+from benchmark.dataset_split_benchmark import benchmark_stratified_split
+from config import BASE_DIR, config, SRC_DIR
+from data.gpt2_dataset import GPT2Dataset, GPT2TokenWindowDataset
+from data.storage_manager import StorageManager
+from log import log
+from models.gpt2 import GPT2
+from ray_quickstart.dataset_cache import compute_array_hash
+from ray_quickstart.packaging import build_working_dir_package
+from training.gpt2_trainer_initializer import GPT2TrainerInitializer
+from training.training_args import create_training_args, training_args_to_dict
+from training.trainer import create_scaling_config
+
+BENCHMARKS_DIR = BASE_DIR + '/benchmarks'
+BASELINE_FILE_PATH = BENCHMARKS_DIR + '/baseline.json'
+STAGES = ('dataset_load',
+          'gpt2_batch_access',
+          'token_dtype',
+          'dataloader_prefetch',
+          'stratified_split',
+          'token_buffer',
+          'convert_to_ray_dataset',
+          'hf_iterable',
+          'local_train',
+          'ray_train',
+          'predict')
+RAY_STAGES = ('convert_to_ray_dataset', 'hf_iterable', 'ray_train')
+DEFAULT_TOLERANCE = 0.1
+# the metrics are compared with the baseline by their suffix: the other metrics (like num_workers) are informative
+HIGHER_IS_BETTER_SUFFIXES = ('_per_sec',)
+LOWER_IS_BETTER_SUFFIXES = ('_sec', '_bytes')
+
+
+class BenchmarkStorageManager(StorageManager):
+    """Reads the project's data but keeps the models, runs and logs of the benchmark in a temporary directory."""
+
+    def __init__(self, tmp_dir):
+        super().__init__()
+        self.tmp_dir = tmp_dir
+
+    def get_logs_dir(self):
+        return self.tmp_dir + '/logs'
+
+    def get_models_dir(self):
+        return self.tmp_dir + '/models'
+
+    def get_runs_dir(self):
+        return self.tmp_dir + '/runs'
+
+
+class TinyGPT2(GPT2):
+    """GPT2 model with a tiny configuration that is created from scratch, so the benchmark needs no download."""
+
+    def __init__(self, storage_manager, model_name='shakespeare_char', block_size=64, vocab_size=65):
+        self.block_size = block_size
+        self.vocab_size = vocab_size
+        super().__init__(storage_manager, model_name, None)
+
+    def _do_create_model_config(self):
+        return GPT2Config(vocab_size=self.vocab_size, n_positions=self.block_size, n_embd=64, n_layer=2, n_head=2,
+                          block_size=self.block_size)
+
+    def _do_create_model(self, model_config):
+        return GPT2LMHeadModel(model_config)
+
+    def load_model_config(self, model_config_name=None):
+        return None
+
+    def load_training_args(self, training_args_name=None):
+        return {'per_device_train_batch_size': 16, 'per_device_eval_batch_size': 16}
+
+
+def run_benchmarks(stages=STAGES, num_train_steps=20, num_ray_workers=2, output_file_path=None,
+                   baseline_file_path=BASELINE_FILE_PATH, tolerance=DEFAULT_TOLERANCE, update_baseline=False):
+    """
+    Run the stages of the benchmark and write the results to output_file_path (a timestamped file in the benchmarks
+    dir by default).
+
+    :param num_ray_workers: The number of CPU workers of the Ray Train benchmark, which runs on a local Ray cluster.
+    :param update_baseline: Whether to write the results to baseline_file_path after the comparison, to accept them as
+           the new baseline.
+    :return: the results and the regressions found by compare_with_baseline().
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='ray_quickstart_benchmark_')
+    storage_manager = BenchmarkStorageManager(tmp_dir)
+    model = TinyGPT2(storage_manager)
+    model.load_or_create_model()
+    trainer_initializer = GPT2TrainerInitializer(storage_manager, model, None)
+    results = {'environment': get_environment(), 'stages': {}}
+    try:
+        if any(stage in RAY_STAGES for stage in stages) and not ray.is_initialized():
+            ray.init(num_cpus=max(os.cpu_count(), num_ray_workers + 2),
+                     runtime_env={'working_dir': build_working_dir_package(SRC_DIR)})
+        for stage in stages:
+            log.info(f'running {stage} benchmark...')
+            try:
+                stage_results = BENCHMARKS[stage](trainer_initializer, model, num_train_steps=num_train_steps,
+                                                  num_ray_workers=num_ray_workers, tmp_dir=tmp_dir)
+            except Exception as e:
+                log.exception(f'{stage} benchmark failed')
+                stage_results = {'error': repr(e)}
+            results['stages'][stage] = stage_results
+            log.info(f'{stage}: {stage_results}')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    if output_file_path is None:
+        output_file_path = f'{BENCHMARKS_DIR}/results_{time.strftime("%Y%m%d_%H%M%S")}.json'
+    write_results(results, output_file_path)
+    regressions = []
+    if baseline_file_path is not None and os.path.exists(baseline_file_path):
+        with open(baseline_file_path) as f:
+            regressions = compare_with_baseline(results, json.load(f), tolerance)
+    if baseline_file_path is not None and update_baseline:
+        write_results(results, baseline_file_path)
+    return results, regressions
+
+
+def get_environment():
+    return {'python': sys.version.split()[0],
+            'platform': python_platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'torch': torch.__version__,
+            'transformers': transformers.__version__,
+            'ray': ray.__version__}
+
+
+def write_results(results, file_path):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    log.info(f'wrote benchmark results to {file_path}')
+
+
+def compare_with_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare every metric of results with the same metric of baseline.
+
+    :return: the regressions as a list of (stage, metric, baseline value, value) for the metrics that got worse by more
+             than tolerance (a fraction of the baseline value).
+    """
+    regressions = []
+    lines = [f'{"stage":<26} {"metric":<24} {"baseline":>12} {"current":>12} {"change":>8}']
+    for stage, stage_results in results['stages'].items():
+        baseline_stage_results = baseline.get('stages', {}).get(stage, {})
+        for metric, value in stage_results.items():
+            baseline_value = baseline_stage_results.get(metric)
+            higher_is_better = metric.endswith(HIGHER_IS_BETTER_SUFFIXES)
+            lower_is_better = not higher_is_better and metric.endswith(LOWER_IS_BETTER_SUFFIXES)
+            if not (higher_is_better or lower_is_better) \
+                    or not isinstance(value, (int, float)) or not isinstance(baseline_value, (int, float)) \
+                    or baseline_value == 0:
+                continue
+            change = (value - baseline_value) / baseline_value
+            is_regression = (change > tolerance) if lower_is_better else (change < -tolerance)
+            if is_regression:
+                regressions.append((stage, metric, baseline_value, value))
+            lines.append(f'{stage:<26} {metric:<24} {baseline_value:>12.4g} {value:>12.4g} {change:>+8.1%}'
+                         f'{is_regression and "  REGRESSION" or ""}')
+    log.info('benchmark comparison with baseline:\n' + '\n'.join(lines))
+    if len(regressions) > 0:
+        log.warning(f'{len(regressions)} benchmark metrics regressed by more than {tolerance:.0%}')
+    return regressions
+
+
+def benchmark_dataset_load(trainer_initializer, model, **kwargs):
+    results = {}
+    for name, use_memmap in (('fromfile', False), ('memmap', True)):
+        start_time = time.perf_counter()
+        dataset = GPT2Dataset(model, use_memmap=use_memmap)
+        dataset.__getitems__(np.arange(min(len(dataset), 1024)))  # touch the data so memmap pays for reading it
+        results[f'{name}_sec'] = time.perf_counter() - start_time
+    return results
+
+
+def benchmark_gpt2_batch_access_stage(trainer_initializer, model, **kwargs):
+    samples_per_sec = benchmark_gpt2_batch_access(GPT2Dataset(model))
+    return {f'{name}_samples_per_sec': value for name, value in samples_per_sec.items()}
+
+
+def benchmark_token_dtype_stage(trainer_initializer, model, **kwargs):
+    results = benchmark_token_dtype(GPT2Dataset(model), model.get_model().config.vocab_size,
+                                    device=torch.device('cpu'))
+    metrics = {}
+    for name, result in results.items():
+        metrics[f'{name}_batch_bytes'] = result['bytes_per_batch']
+        metrics[f'{name}_samples_per_sec'] = result['samples_per_sec']
+    return metrics
+
+
+def benchmark_dataloader_prefetch_stage(trainer_initializer, model, **kwargs):
+    step_times = benchmark_dataloader_prefetch(GPT2Dataset(model), trainer_initializer.data_collator_init(model),
+                                               model.get_model())
+    return {f'{name}_step_sec': value for name, value in step_times.items()}
+
+
+def benchmark_stratified_split_stage(trainer_initializer, model, **kwargs):
+    timings = benchmark_stratified_split()
+    return {f'{name}_sec': value for name, value in timings.items()}
+
+
+def benchmark_token_buffer(trainer_initializer, model, **kwargs):
+    # the work convert_to_ray_dataset() does on the driver before it asks the nodes for the cached token buffer
+    dataset = GPT2Dataset(model)
+    start_time = time.perf_counter()
+    token_buffer = dataset.get_token_buffer()
+    compute_array_hash(token_buffer)
+    return {'wall_time_sec': time.perf_counter() - start_time, 'buffer_bytes': token_buffer.nbytes}
+
+
+def benchmark_convert_to_ray_dataset(trainer_initializer, model, **kwargs):
+    dataset = GPT2Dataset(model)
+    start_time = time.perf_counter()
+    trainer_initializer.convert_to_ray_dataset(dataset)
+    first_time = time.perf_counter() - start_time
+    # the second conversion finds the token buffer in the dataset cache of the nodes
+    start_time = time.perf_counter()
+    trainer_initializer.convert_to_ray_dataset(dataset)
+    return {'first_wall_time_sec': first_time, 'cached_wall_time_sec': time.perf_counter() - start_time}
+
+
+def benchmark_hf_iterable(trainer_initializer, model, **kwargs):
+    dataset = GPT2Dataset(model)
+    ray_dataset = trainer_initializer.convert_to_ray_dataset(dataset)
+    iterable = GPT2TokenWindowDataset(ray_dataset, ray_dataset,
+                                      trainer_initializer.token_buffers[dataset.dataset_name].load(),
+                                      dataset.block_size, dataset.offset_sampler)
+    collator = trainer_initializer.data_collator_init(model)
+    num_examples = 0
+    batch = []
+    start_time = time.perf_counter()
+    for example in iterable:
+        batch.append(example)
+        if len(batch) == 64:
+            collator(batch)
+            num_examples += len(batch)
+            batch = []
+        if num_examples >= 64 * 200:
+            break
+    return {'samples_per_sec': num_examples / (time.perf_counter() - start_time)}
+
+
+def benchmark_local_train(trainer_initializer, model, num_train_steps=20, tmp_dir=None, **kwargs):
+    train_dataset, eval_dataset = trainer_initializer.get_train_and_eval_datasets(model)
+    args = _create_benchmark_training_args(trainer_initializer, model, num_train_steps, tmp_dir)
+    trainer_init_config = {'model': model,
+                           'args': args,
+                           'data_collator': trainer_initializer.data_collator_init(model),
+                           'compute_metrics': None}
+    trainer = trainer_initializer.trainer_init_per_worker(train_dataset, eval_dataset, **trainer_init_config)
+    start_time = time.perf_counter()
+    metrics = trainer.train().metrics
+    wall_time = time.perf_counter() - start_time
+    return {'steps_per_sec': metrics.get('train_steps_per_second', num_train_steps / wall_time),
+            'samples_per_sec': metrics.get('train_samples_per_second'),
+            'wall_time_sec': wall_time}
+
+
+def benchmark_ray_train(trainer_initializer, model, num_train_steps=20, num_ray_workers=2, tmp_dir=None, **kwargs):
+    train_dataset, eval_dataset = trainer_initializer.get_train_and_eval_datasets(model)
+    ray_train_dataset = trainer_initializer.convert_to_ray_dataset(train_dataset)
+    ray_eval_dataset = trainer_initializer.convert_to_ray_dataset(eval_dataset)
+    benchmark_config = _copy_config(num_ray_workers=num_ray_workers, use_gpu_on_ray_cluster=False)
+    scaling_config = create_scaling_config(benchmark_config)
+    args = _create_benchmark_training_args(trainer_initializer, model, num_train_steps, tmp_dir)
+    # the results of the run go to the temporary directory of the benchmark rather than to ~/ray_results
+    trainer = trainer_initializer.trainer_init(model, args, ray_train_dataset, ray_eval_dataset, scaling_config,
+                                               local_dir=f'{tmp_dir}/ray_results')
+    start_time = time.perf_counter()
+    result = trainer.fit()
+    wall_time = time.perf_counter() - start_time
+    metrics = result.metrics or {}
+    return {'steps_per_sec': metrics.get('train_steps_per_second', num_train_steps / wall_time),
+            'samples_per_sec': metrics.get('train_samples_per_second'),
+            'wall_time_sec': wall_time,
+            'num_workers': scaling_config.num_workers}
+
+
+def benchmark_predict(trainer_initializer, model, num_runs=10, prompt_length=16, max_new_tokens=32, **kwargs):
+    hf_model = model.get_model()
+    hf_model.eval()
+    input_ids = torch.randint(0, hf_model.config.vocab_size, (1, prompt_length))
+    latencies = []
+    with torch.no_grad():
+        hf_model.generate(input_ids=input_ids, max_new_tokens=max_new_tokens, pad_token_id=0)  # warm up
+        for _ in range(num_runs):
+            start_time = time.perf_counter()
+            hf_model.generate(input_ids=input_ids, max_new_tokens=max_new_tokens, pad_token_id=0)
+            latencies.append(time.perf_counter() - start_time)
+    hf_model.train()
+    return {'latency_p50_sec': float(np.percentile(latencies, 50)),
+            'latency_p90_sec': float(np.percentile(latencies, 90)),
+            'tokens_per_sec': max_new_tokens / float(np.mean(latencies))}
+
+
+def _create_benchmark_training_args(trainer_initializer, model, num_train_steps, tmp_dir):
+    args = trainer_initializer.trainer_args_init(model,
+                                                 tensorboard_logging_strategy='no',
+                                                 save_strategy='no',
+                                                 evaluation_strategy='no',
+                                                 disable_tqdm=True)
+    return create_training_args(training_args_to_dict(args),
+                                {'max_steps': num_train_steps,
+                                 'output_dir': f'{tmp_dir}/runs',
+                                 'logging_dir': f'{tmp_dir}/logs',
+                                 'load_best_model_at_end': False,
+                                 'report_to': []},
+                                'the benchmark')
+
+
+def _copy_config(**overrides):
+    benchmark_config = type(config).__new__(type(config))
+    benchmark_config.__dict__.update(config.__dict__)
+    benchmark_config.__dict__.update(overrides)
+    return benchmark_config
+
+
+BENCHMARKS = {'dataset_load': benchmark_dataset_load,
+              'gpt2_batch_access': benchmark_gpt2_batch_access_stage,
+              'token_dtype': benchmark_token_dtype_stage,
+              'dataloader_prefetch': benchmark_dataloader_prefetch_stage,
+              'stratified_split': benchmark_stratified_split_stage,
+              'token_buffer': benchmark_token_buffer,
+              'convert_to_ray_dataset': benchmark_convert_to_ray_dataset,
+              'hf_iterable': benchmark_hf_iterable,
+              'local_train': benchmark_local_train,
+              'ray_train': benchmark_ray_train,
+              'predict': benchmark_predict}
@@ -30,6 +30,42 @@ class Config:
         self.force_cpu = False # may be useful if your GPU does not have enough memory to run the training
         self.truncate_dataset_to_size = None # may be useful if your GPU does not have enough memory to run the training
 
+        # how the examples of each epoch are sampled from the GPT2 token buffer: 'all' (every offset), 'random' (random
+        # offsets, seeded per epoch and worker) or 'stride' (non-overlapping windows)
+        self.dataset_sampling_mode = 'all'
+        self.dataset_num_samples_per_epoch = None # required for 'random' sampling, caps the examples for 'stride'
+        self.eval_dataset_sampling_mode = 'all'
+        self.eval_dataset_num_samples = None
+
+        # DataLoader settings, overridden by the dataloader_* training args in train.yaml: with workers, the batches are
+        # prepared in background processes while the training step runs
+        self.dataloader_num_workers = min(4, max(platform.get_cpu_device_count() - 1, 0))
+        self.dataloader_prefetch_factor = 2 # batches prepared ahead by each worker
+        self.dataloader_persistent_workers = True # keep the workers alive between epochs, unless resampled
+        self.dataloader_pin_memory = True # only used when training on a GPU
+
+        # layout of the Ray Train workers: the settings left to None are derived from the resources of the Ray cluster
+        # (see training.trainer.create_scaling_config). To try multi-worker DDP on CPU on a single machine, set
+        # use_gpu_on_ray_cluster to False and num_ray_workers to 2 or more.
+        self.num_ray_workers = None # number of data-parallel workers
+        self.cpus_per_ray_worker = None
+        self.gpus_per_ray_worker = None
+        self.use_gpu_on_ray_cluster = None # defaults to True if the cluster has GPUs
+        self.num_ray_trainer_cpus = 1 # CPUs reserved for the trainer actor that coordinates the workers
+
+        # torch.profiler capture of the training steps, overridden by the same settings in train.yaml: the Chrome traces
+        # and operator tables are written to the trial dir on the Ray workers (and brought back by the syncer) or to
+        # logs/profiler when training locally
+        self.profile_training = False
+        self.profiler_wait_steps = 1 # steps skipped before each profiling cycle
+        self.profiler_warmup_steps = 1 # steps profiled but discarded, so the warm-up overhead is not measured
+        self.profiler_active_steps = 3 # steps recorded in each trace
+        self.profiler_repeat = 1 # number of profiling cycles, 0 to profile until the end of the training
+
+        # add the time of each phase of the training steps (data wait, forward, backward, optimizer step and checkpoint
+        # save) to the training logs, which go to TensorBoard and to the Ray Train metrics (see training.timed_trainer)
+        self.time_training_steps = False
+
     def get_run_on_ray_cluster(self):
         return self.run_on_ray_cluster
 
@@ -0,0 +1,55 @@
+"""
+Node-local cache of the token stores used for training on the Ray cluster, shard by shard, so a store larger than
+memory never has to be read as a whole on the driver.
+"""
+import hashlib
+import json
+
+from data.token_store import get_index_path, TokenStore
+from ray_quickstart.dataset_cache import cache_files_on_cluster, DEFAULT_DATASET_CACHE_DIR, get_cached_files_dir
+
+
+class CachedTokenStore:
+    """
+    Reference to a token store in the dataset cache of the nodes of the Ray cluster. Like CachedArray, it is cheap to
+    send to the Ray workers, which open the store from their node's cache with load().
+    """
+
+    def __init__(self, name, cache_dir=DEFAULT_DATASET_CACHE_DIR):
+        self.name = name
+        self.cache_dir = cache_dir
+
+    def load(self):
+        """returns the token store memory-mapped from the node's cache"""
+        files_dir = get_cached_files_dir(self.cache_dir)
+        try:
+            return TokenStore(files_dir, self.name)
+        except FileNotFoundError as e:
+            raise FileNotFoundError(f'{self} is not in the dataset cache of this node: the node probably joined the '
+                                    f'cluster after the token store was cached') from e
+
+    def __str__(self):
+        return f'cached token store {self.name[:12]}'
+
+
+def cache_token_store_on_cluster(token_store, cache_dir=DEFAULT_DATASET_CACHE_DIR):
+    """
+    Make sure that the shards of the token store are in the dataset cache of every node of the Ray cluster. The shards
+    are cached under the sha256 recorded in the index, so they do not have to be read to be hashed and a shard is only
+    sent to the nodes that do not have it yet, even by another version of the store. The store is cached with its own
+    index, which refers to the cached shards and is named after the hash of its contents.
+
+    :return: the CachedTokenStore to send to the Ray workers instead of the token store.
+    """
+    with open(get_index_path(token_store.dir_path, token_store.name)) as f:
+        index = json.load(f)
+    files = {}
+    for shard in index['shards']:
+        file_name = f'{shard["sha256"]}.tokens'
+        files[file_name] = f'{token_store.dir_path}/{shard["file"]}'
+        shard['file'] = file_name
+    index_contents = json.dumps(index, indent=2).encode('utf-8')
+    name = hashlib.sha256(index_contents).hexdigest()
+    files[f'{name}.idx.json'] = index_contents
+    cache_files_on_cluster(files, cache_dir)
+    return CachedTokenStore(name, cache_dir)
@@ -1,5 +1,6 @@
+import numpy as np
 import torch
-from torch.utils.data import random_split
+from torch.utils.data import random_split, Subset
 
 from config import config
 
@@ -13,27 +14,43 @@ def split_dataset_random(dataset, split_ratio):
 
 
 def split_dataset_for_classification(dataset, split_ratio):
-    """Split dataset into two datasets according to split ratio and stratify by class"""
-    examples_for_classes_in_dataset = {}
-    for example in dataset:
-        label = example['label']
-        if label not in examples_for_classes_in_dataset:
-            examples_for_classes_in_dataset[label] = []
-        examples_for_classes_in_dataset[label].append(example)
-    train_dataset = []
-    eval_dataset = []
-    for example_class in examples_for_classes_in_dataset.keys():
-        examples = examples_for_classes_in_dataset[example_class]
-        num_examples = len(examples)
-        if num_examples == 0:
-            continue
-        elif num_examples == 1:
-            train_dataset.append(examples[0])
+    """
+    Split dataset into two datasets according to split ratio and stratify by class. Only the labels are read from the
+    dataset: the splits are Subsets holding the indices of their examples. Each class is split with the same seeded
+    permutation as split_dataset_random(), so the splits are the same as when the examples of each class were split
+    separately.
+    """
+    labels = get_labels(dataset)
+    # number the classes in the order they first appear, then group the indices of the examples by class while keeping
+    # them in dataset order within each class
+    classes, first_indices, class_ids = np.unique(labels, return_index=True, return_inverse=True)
+    class_ids = np.argsort(np.argsort(first_indices))[class_ids.reshape(-1)]
+    indices_by_class = np.argsort(class_ids, kind='stable')
+    class_ends = np.cumsum(np.bincount(class_ids, minlength=len(classes)))
+    train_indices = []
+    eval_indices = []
+    for class_start, class_end in zip(np.concatenate(([0], class_ends[:-1])), class_ends):
+        indices = indices_by_class[class_start:class_end]
+        num_examples = len(indices)
+        if num_examples == 1:
+            train_indices.append(indices)
         elif num_examples == 2:
-            train_dataset.append(examples[0])
-            eval_dataset.append(examples[1])
+            train_indices.append(indices[:1])
+            eval_indices.append(indices[1:])
         else:
-            train_examples, test_examples = split_dataset_random(examples, split_ratio)
-            train_dataset.extend(train_examples)
-            eval_dataset.extend(test_examples)
-    return train_dataset, eval_dataset
+            split_index = int(num_examples * split_ratio)
+            permutation = torch.randperm(num_examples, generator=torch.Generator().manual_seed(config.seed)).numpy()
+            train_indices.append(indices[permutation[:split_index]])
+            eval_indices.append(indices[permutation[split_index:]])
+    return Subset(dataset, _concatenate(train_indices)), Subset(dataset, _concatenate(eval_indices))
+
+
+def get_labels(dataset):
+    """returns the labels of the examples in dataset as a NumPy array, reading the label column directly if it has one"""
+    if 'label' in getattr(dataset, 'column_names', ()):
+        return np.asarray(dataset['label'])
+    return np.asarray([example['label'] for example in dataset])
+
+
+def _concatenate(indices):
+    return np.concatenate(indices).tolist() if len(indices) > 0 else []
@@ -0,0 +1,58 @@
+"""
+Data collator for use with GPT2 model.
+"""
+import numpy as np
+import torch
+
+
+def get_compact_token_dtype(vocab_size):
+    """
+    returns the smallest signed dtype that holds the token ids of the vocabulary (torch has no uint16 tensors) or int64
+    if the vocab size is unknown
+    """
+    if vocab_size is None:
+        return np.dtype(np.int64)
+    if vocab_size <= np.iinfo(np.int16).max + 1:
+        return np.dtype(np.int16)
+    return np.dtype(np.int32)
+
+
+class GPT2DataCollator:
+    """
+    Collates GPT2 examples into a batch of tensors. A batch that has already been gathered by
+    GPT2Dataset.__getitems__() is converted to tensors as is, otherwise the examples are stacked per key in one
+    operation. The input ids stay uint16 until this final copy, which converts them to the compact dtype of the
+    vocabulary: they are only widened to int64 by GPT2.forward() once they are on the device. The labels are collated
+    as int64, because the Trainer gathers them across the Ray workers during evaluation and the gloo backend cannot
+    all_gather int16 tensors.
+    """
+
+    def __init__(self, vocab_size=None):
+        """
+        :param vocab_size: The vocab size of the model, used to pick the dtype of the input ids (int16 or int32).
+               Defaults to int64 input ids when it is not given.
+        """
+        self.token_dtype = get_compact_token_dtype(vocab_size)
+
+    def __call__(self, features):
+        if len(features) == 1 and np.ndim(features[0]['input_ids']) == 2:
+            return {key: self._to_tensor(key, value) for key, value in features[0].items()}
+        return {key: self._stack(key, [feature[key] for feature in features]) for key in features[0].keys()}
+
+    def _stack(self, key, values):
+        if isinstance(values[0], torch.Tensor):
+            return torch.stack(values)
+        return self._to_tensor(key, np.stack(values))
+
+    def _to_tensor(self, key, value):
+        if isinstance(value, torch.Tensor):
+            return value
+        value = np.asarray(value)
+        token_dtype = key == 'input_ids' and self.token_dtype or np.dtype(np.int64)
+        if value.dtype.kind in 'ui' and value.dtype != token_dtype:
+            if value.dtype == np.uint16 and token_dtype == np.int16:
+                # the token ids are below 32768, so they have the same bits as uint16 and int16
+                value = value.view(np.int16)
+            else:
+                value = value.astype(token_dtype)
+        return torch.from_numpy(np.ascontiguousarray(value))
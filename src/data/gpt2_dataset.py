@@ -1,18 +1,32 @@
 """
 Dataset for use with GPT2 model.
 """
+from collections.abc import Mapping
+
 import numpy as np
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 
 from config import config
+from data.offset_sampler import OffsetSampler
+from data.token_store import gather_windows, token_store_exists, TokenStore
 from log import log
 
 
 class GPT2Dataset(Dataset):
     """
     This dataset is unique in that the examples are permutations of the same underlying text. It would be very inefficient
-    to generate all the examples locally and then copy them over the network. Instead, we just send the underlying text and
-    generate the examples on the fly from the monkey-patched RayDatasetHFIterable.
+    to generate all the examples locally and then copy them over the network. Instead, we just send the underlying text
+    (see get_token_buffer()) with a dataset of example offsets and generate the examples on the fly on the Ray worker
+    using GPT2TokenWindowDataset.
+
+    Which windows make up an epoch is decided by an OffsetSampler configured by config.dataset_sampling_mode (or
+    config.eval_dataset_sampling_mode for the eval dataset).
+
+    The examples are views of the uint16 tokens: GPT2DataCollator keeps the input ids in a compact dtype in the batch
+    tensors and the model widens them to int64 on the device.
+
+    The tokens are read from the {train,val} token store in the data dir if there is one (see data.token_store), which
+    is always memory-mapped, and from the headerless uint16 {train,val}.bin file otherwise.
     """
 
     def __init__(self, model, use_memmap=False, is_eval=False):
@@ -20,7 +34,9 @@ class GPT2Dataset(Dataset):
         self.model = model
         self.dataset_name = is_eval and 'val' or 'train'
         self.block_size = model.model.config.block_size
-        if use_memmap:
+        if token_store_exists(self.get_data_dir(), self.dataset_name):
+            self.data = TokenStore(self.get_data_dir(), self.dataset_name)
+        elif use_memmap:
             self.data = np.memmap(self.get_file_path(),
                                   dtype=np.uint16,
                                   mode='r')
@@ -28,21 +44,67 @@ class GPT2Dataset(Dataset):
             self.data = np.fromfile(self.get_file_path(),
                                     dtype=np.uint16)
         log.info(f'loaded {len(self.data)} examples')
+        if is_eval:
+            sampling_mode, num_samples = config.eval_dataset_sampling_mode, config.eval_dataset_num_samples
+        else:
+            sampling_mode, num_samples = config.dataset_sampling_mode, config.dataset_num_samples_per_epoch
+        self.offset_sampler = OffsetSampler(self.get_num_offsets(), self.block_size, sampling_mode, num_samples,
+                                            seed=config.seed)
+
+    def __getstate__(self):
+        # the DataLoader worker processes only need the tokens: leave the model out of the pickled dataset
+        state = self.__dict__.copy()
+        state['model'] = None
+        return state
+
+    def get_data_dir(self):
+        return f'{self.model.storage_manager.get_data_dir()}/{self.model.model_name}'
 
     def get_file_path(self):
-        return f'{self.model.storage_manager.get_data_dir()}/{self.model.model_name}/{self.dataset_name}.bin'
+        return f'{self.get_data_dir()}/{self.dataset_name}.bin'
 
     def __len__(self):
+        return len(self.offset_sampler)
+
+    def get_num_offsets(self):
         if config.truncate_dataset_to_size is not None:
             return config.truncate_dataset_to_size
         return self.get_num_examples()
 
+    def set_epoch(self, epoch):
+        self.offset_sampler.set_epoch(epoch)
+
+    def set_rank(self, rank):
+        self.offset_sampler.set_rank(rank)
+
     def __getitem__(self, index):
         if index >= len(self):
             raise IndexError('index out of range')
-        x = self.data[index:index+self.block_size].astype(np.int64)
-        y = self.data[index+1:index+1+self.block_size].astype(np.int64)
-        return {'input_ids': x, 'labels': y}
+        offset = self.offset_sampler.get_offsets(index)
+        window = self.data[offset:offset+self.block_size+1]
+        return {'input_ids': window[:-1], 'labels': window[1:]}
+
+    def __getitems__(self, indices):
+        """
+        Returns the examples for a whole batch of indices, gathered in one vectorized copy. The batch is returned as a
+        single item holding 2D arrays so it can pass through the Trainer's collator wrapper to GPT2DataCollator as is.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) > 0 and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError('index out of range')
+        offsets = self.offset_sampler.get_offsets(indices)
+        windows = gather_windows(self.data, offsets, self.block_size + 1)
+        return [{'input_ids': windows[:, :-1], 'labels': windows[:, 1:]}]
+
+    def get_token_buffer(self):
+        """
+        returns the underlying tokens as a contiguous array that can be put in the Ray object store once and read by the
+        workers without copying, or the TokenStore itself when the tokens come from a token store, which may not fit in
+        memory and has to be sent to the workers shard by shard (see data.cached_token_store)
+        """
+        if isinstance(self.data, TokenStore):
+            return self.data
+        return np.ascontiguousarray(self.data)
 
     def get_data_for_ray_dataset(self):
         # get the data as a numpy array to allow for efficient transfer to the remote workers
@@ -51,3 +113,48 @@ class GPT2Dataset(Dataset):
     def get_num_examples(self):
         """You can edit to return a smaller number if you are running out of memory when trying to train on this dataset"""
         return len(self.data) - self.block_size
+
+
+class GPT2TokenWindowDataset(IterableDataset):
+    """
+    Generates the GPT2 examples on the Ray worker from the example indices in the worker's shard of the Ray dataset and
+    the token buffer shared through the Ray object store. The indices are mapped to token buffer offsets by the
+    OffsetSampler of the GPT2Dataset the Ray dataset was created from.
+
+    The shard is read a batch of indices at a time and the windows of a batch are gathered in one vectorized copy that
+    stays uint16: the examples are views of it.
+    """
+
+    def __init__(self, indices_dataset, dataset_shard, tokens, block_size, offset_sampler, batch_size=1024):
+        """
+        :param indices_dataset: The HuggingFace dataset Ray created from the shard, which provides the number of
+               examples.
+        :param dataset_shard: The worker's shard of the Ray dataset of example indices.
+        """
+        super().__init__()
+        self.indices_dataset = indices_dataset
+        self.dataset_shard = dataset_shard
+        self.tokens = tokens
+        self.block_size = block_size
+        self.offset_sampler = offset_sampler
+        self.batch_size = batch_size
+        # the shard is already split between the workers, so the Trainer must not split it again
+        self._do_not_split = getattr(indices_dataset, '_do_not_split', False)
+
+    def __len__(self):
+        return len(self.indices_dataset)
+
+    def set_epoch(self, epoch):
+        self.offset_sampler.set_epoch(epoch)
+
+    def set_rank(self, rank):
+        self.offset_sampler.set_rank(rank)
+
+    def __iter__(self):
+        for batch in self.dataset_shard.iter_batches(batch_size=self.batch_size, batch_format='numpy'):
+            if isinstance(batch, Mapping):
+                batch = next(iter(batch.values()))
+            offsets = self.offset_sampler.get_offsets(np.asarray(batch, dtype=np.int64).reshape(-1))
+            windows = gather_windows(self.tokens, offsets, self.block_size + 1)
+            for window in windows:
+                yield {'input_ids': window[:-1], 'labels': window[1:]}
@@ -0,0 +1,73 @@
+"""
+Chooses which windows of a token buffer make up each epoch of a language model dataset.
+"""
+import numpy as np
+
+SAMPLING_MODES = ('all', 'random', 'stride')
+
+
+class OffsetSampler:
+    """
+    Maps the example indices of an epoch to offsets into a token buffer with num_offsets valid window offsets:
+    - 'all': every offset, i.e. every (heavily overlapping) window of the buffer
+    - 'random': num_samples offsets drawn at random
+    - 'stride': non-overlapping windows, block_size apart, starting from a random phase
+    The random draws are seeded by (seed, epoch, rank), so each epoch and each worker sees different examples while runs
+    stay reproducible. num_samples caps the number of examples per epoch for the 'random' and 'stride' modes.
+    """
+
+    def __init__(self, num_offsets, block_size, mode='all', num_samples=None, seed=0, rank=0):
+        if mode not in SAMPLING_MODES:
+            raise ValueError(f'unknown sampling mode {mode}: must be one of {SAMPLING_MODES}')
+        if mode == 'random' and num_samples is None:
+            raise ValueError("num_samples must be set for the 'random' sampling mode")
+        self.num_offsets = num_offsets
+        self.block_size = block_size
+        self.mode = mode
+        self.num_samples = num_samples
+        self.seed = seed
+        self.rank = rank
+        self.epoch = 0
+        self.offsets = None
+
+    def __len__(self):
+        if self.mode == 'all':
+            return self.num_offsets
+        if self.mode == 'random':
+            return self.num_samples
+        num_strides = max(self.num_offsets // self.block_size, 1)
+        return num_strides if self.num_samples is None else min(num_strides, self.num_samples)
+
+    def is_resampled_per_epoch(self):
+        """whether the offsets change with the epoch, i.e. whether set_epoch() has to reach every copy of the sampler"""
+        return self.mode != 'all'
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.offsets = None
+
+    def set_rank(self, rank):
+        if rank != self.rank:
+            self.rank = rank
+            self.offsets = None
+
+    def get_offsets(self, indices):
+        """returns the token buffer offsets of the given example indices (an int or an array of ints)"""
+        if self.mode == 'all':
+            return indices
+        if self.offsets is None:
+            self.offsets = self._sample_offsets()
+        return self.offsets[indices]
+
+    def _sample_offsets(self):
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank])
+        if self.mode == 'random':
+            return rng.integers(0, self.num_offsets, size=self.num_samples)
+        num_strides = max(self.num_offsets // self.block_size, 1)
+        # the random phase keeps the last window in range while letting every offset be visited across epochs
+        start = rng.integers(0, self.num_offsets - (num_strides - 1) * self.block_size)
+        offsets = start + np.arange(num_strides) * self.block_size
+        if self.num_samples is not None and self.num_samples < num_strides:
+            offsets = np.sort(rng.choice(offsets, size=self.num_samples, replace=False))
+        return offsets
@@ -0,0 +1,243 @@
+"""
+Prepares the train.bin, val.bin and meta.pkl files of a dataset from a raw text corpus.
+
+The corpus is streamed in chunks that end at a newline, the chunks are tokenized in a process pool and the tokens are
+written to the output files as soon as they are ready, so the corpus never has to fit in memory. As in nanoGPT, the
+first (1 - val_ratio) of the characters of the corpus go to train.bin and the rest go to val.bin. The result is cached:
+when the corpus, tokenizer and settings are unchanged, the existing output files are kept. The outputs of the other
+format are removed, since GPT2Dataset reads a token store in preference to a .bin file.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+
+from data.token_store import remove_token_store, TokenStoreWriter
+from log import log
+from util.platform import get_cpu_device_count
+
+TOKENIZERS = ('char', 'gpt2')
+OUTPUT_FORMATS = ('bin', 'token_store')
+CACHE_FILE_NAME = '.prepare_dataset_cache.json'
+CACHE_VERSION = 1
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024  # in characters
+READ_SIZE = 16 * 1024 * 1024  # in bytes, for hashing
+
+_tokenizer = None  # the tokenizer of the pool worker process
+
+
+def prepare_dataset(input_path,
+                    output_dir,
+                    tokenizer='char',
+                    val_ratio=0.1,
+                    output_format='bin',
+                    chunk_size=DEFAULT_CHUNK_SIZE,
+                    num_workers=None,
+                    force=False):
+    """
+    Tokenize the text file at input_path into output_dir.
+
+    :param tokenizer: 'char' for a character-level vocabulary built from the corpus or 'gpt2' for the GPT-2 tokenizer.
+    :param output_format: 'bin' for nanoGPT's headerless uint16 {train,val}.bin files or 'token_store' for sharded token
+           stores (see data.token_store). meta.pkl is written for both.
+    :param num_workers: The number of tokenizer processes. Defaults to the number of CPUs.
+    :param force: Whether to tokenize the corpus even if the cached output files are up to date.
+    :return: the number of tokens written to the train and val outputs.
+    """
+    if tokenizer not in TOKENIZERS:
+        raise ValueError(f'unknown tokenizer {tokenizer}: must be one of {TOKENIZERS}')
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'unknown output format {output_format}: must be one of {OUTPUT_FORMATS}')
+    os.makedirs(output_dir, exist_ok=True)
+    settings = {'version': CACHE_VERSION,
+                'tokenizer': tokenizer,
+                'val_ratio': val_ratio,
+                'output_format': output_format}
+    cache = _load_cache(output_dir)
+    input_hash = _get_input_hash(input_path, cache)
+    if not force and cache.get('input_sha256') == input_hash and cache.get('settings') == settings \
+            and all(os.path.exists(f'{output_dir}/{file_name}') for file_name in cache.get('output_files', ())):
+        log.info(f'{output_dir} is up to date with {input_path}: skipping tokenization')
+        return cache['num_tokens']
+
+    num_chars, chars = _scan_corpus(input_path, collect_chars=tokenizer == 'char')
+    if tokenizer == 'char':
+        itos = dict(enumerate(sorted(chars)))
+        meta = {'vocab_size': len(itos), 'itos': itos, 'stoi': {char: i for i, char in itos.items()}}
+        # the vocabulary is sorted, so the token of a character is the index of its code point in the sorted code points
+        tokenizer_spec = ('char', np.array([ord(char) for char in itos.values()], dtype=np.uint32))
+    else:
+        meta = {'vocab_size': _create_tokenizer(('gpt2', None)).vocab_size, 'tokenizer': 'gpt2'}
+        tokenizer_spec = ('gpt2', None)
+    log.info(f'tokenizing {num_chars} characters of {input_path} with the {tokenizer} tokenizer '
+             f'(vocab size {meta["vocab_size"]})...')
+
+    writers = {name: _create_writer(output_dir, name, meta['vocab_size'], output_format) for name in ('train', 'val')}
+    num_tokens = {'train': 0, 'val': 0}
+    num_workers = num_workers or get_cpu_device_count()
+    split_index = int(num_chars * (1 - val_ratio))
+    with ProcessPoolExecutor(num_workers, initializer=_init_worker, initargs=(tokenizer_spec,)) as executor:
+        # at most 2 chunks per worker are in flight, which bounds the memory used however large the corpus is
+        pending = deque()
+        for name, text in _read_chunks(input_path, chunk_size, split_index):
+            pending.append((name, executor.submit(_tokenize, text)))
+            if len(pending) >= 2 * num_workers:
+                pending_name, future = pending.popleft()
+                num_tokens[pending_name] += _write_tokens(writers[pending_name], future)
+        while pending:
+            name, future = pending.popleft()
+            num_tokens[name] += _write_tokens(writers[name], future)
+    output_files = ['meta.pkl']
+    for name, writer in writers.items():
+        output_files.extend(writer.close())
+        _remove_other_outputs(output_dir, name, output_format)
+    with open(f'{output_dir}/meta.pkl', 'wb') as f:
+        pickle.dump(meta, f)
+    _save_cache(output_dir, {'input_path': os.path.abspath(input_path),
+                             'input_size': os.path.getsize(input_path),
+                             'input_mtime_ns': os.stat(input_path).st_mtime_ns,
+                             'input_sha256': input_hash,
+                             'settings': settings,
+                             'num_tokens': num_tokens,
+                             'output_files': output_files})
+    log.info(f'wrote {num_tokens["train"]} train and {num_tokens["val"]} val tokens to {output_dir}')
+    return num_tokens
+
+
+def _get_input_hash(input_path, cache):
+    """returns the sha256 of the input file, reusing the cached one if the file has not been modified since"""
+    stat = os.stat(input_path)
+    if cache.get('input_path') == os.path.abspath(input_path) and cache.get('input_size') == stat.st_size \
+            and cache.get('input_mtime_ns') == stat.st_mtime_ns:
+        return cache['input_sha256']
+    sha256 = hashlib.sha256()
+    with open(input_path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _scan_corpus(input_path, collect_chars):
+    """returns the number of characters of the corpus and the set of its characters if collect_chars is True"""
+    num_chars = 0
+    chars = set()
+    with open(input_path, 'r', encoding='utf-8') as f:
+        for block in iter(lambda: f.read(DEFAULT_CHUNK_SIZE), ''):
+            num_chars += len(block)
+            if collect_chars:
+                chars.update(block)
+    return num_chars, chars
+
+
+def _read_chunks(input_path, chunk_size, split_index):
+    """
+    Yield ('train' or 'val', text) chunks of about chunk_size characters. Chunks end at a newline when there is one,
+    so the GPT-2 tokenizer does not see words cut in half, and the chunk holding the character at split_index is cut
+    there.
+    """
+    position = 0
+    remainder = ''
+    with open(input_path, 'r', encoding='utf-8') as f:
+        while True:
+            block = f.read(chunk_size)
+            text = remainder + block
+            if not text:
+                break
+            end = len(text) if not block else text.rfind('\n') + 1 or len(text)
+            if position < split_index < position + end:
+                end = split_index - position
+            if position < split_index:
+                yield 'train', text[:end]
+            else:
+                yield 'val', text[:end]
+            position += end
+            remainder = text[end:]
+
+
+def _init_worker(tokenizer_spec):
+    global _tokenizer
+    _tokenizer = _create_tokenizer(tokenizer_spec)
+
+
+def _create_tokenizer(tokenizer_spec):
+    name, code_points = tokenizer_spec
+    if name == 'char':
+        return code_points
+    from transformers import GPT2TokenizerFast
+    return GPT2TokenizerFast.from_pretrained('gpt2')
+
+
+def _tokenize(text):
+    if isinstance(_tokenizer, np.ndarray):
+        return np.searchsorted(_tokenizer, np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)).astype(np.uint32)
+    return np.asarray(_tokenizer(text, add_special_tokens=False)['input_ids'], dtype=np.uint32)
+
+
+def _create_writer(output_dir, name, vocab_size, output_format):
+    if output_format == 'token_store':
+        return _TokenStoreOutput(output_dir, name, vocab_size)
+    return _BinOutput(output_dir, name, vocab_size)
+
+
+def _remove_other_outputs(output_dir, name, output_format):
+    """removes the outputs left by a previous run in the other format, which GPT2Dataset could pick up instead"""
+    if output_format == 'token_store':
+        if os.path.exists(f'{output_dir}/{name}.bin'):
+            os.remove(f'{output_dir}/{name}.bin')
+    else:
+        remove_token_store(output_dir, name)
+
+
+def _write_tokens(writer, future):
+    tokens = future.result()
+    writer.write(tokens)
+    return len(tokens)
+
+
+class _BinOutput:
+    """writes nanoGPT's headerless uint16 .bin file, which only becomes visible once it is complete"""
+
+    def __init__(self, output_dir, name, vocab_size):
+        if vocab_size > np.iinfo(np.uint16).max + 1:
+            raise ValueError(f'a vocab size of {vocab_size} does not fit in a .bin file: use the token_store format')
+        self.file_name = f'{name}.bin'
+        self.file_path = f'{output_dir}/{self.file_name}'
+        self.file = open(f'{self.file_path}.tmp', 'wb')
+
+    def write(self, tokens):
+        self.file.write(tokens.astype(np.uint16).tobytes())
+
+    def close(self):
+        self.file.close()
+        os.replace(f'{self.file_path}.tmp', self.file_path)
+        return [self.file_name]
+
+
+class _TokenStoreOutput:
+
+    def __init__(self, output_dir, name, vocab_size):
+        self.writer = TokenStoreWriter(output_dir, name, vocab_size)
+
+    def write(self, tokens):
+        self.writer.write(tokens)
+
+    def close(self):
+        self.writer.close()
+        return [f'{self.writer.name}.idx.json'] + [shard['file'] for shard in self.writer.shards]
+
+
+def _load_cache(output_dir):
+    try:
+        with open(f'{output_dir}/{CACHE_FILE_NAME}') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(output_dir, cache):
+    with open(f'{output_dir}/{CACHE_FILE_NAME}', 'w') as f:
+        json.dump(cache, f, indent=2)
@@ -0,0 +1,275 @@
+"""
+Sharded, memory-mapped storage for tokenized datasets.
+
+A token store named {name} in a directory consists of an index file {name}.idx.json and one or more shard files
+{name}.{shard_index:05d}.tokens. Each shard starts with a fixed size header describing its tokens, so a shard can be
+checked on its own, followed by the tokens in little-endian order. The index lists the shards in order, and the tokens of
+the store are the concatenation of the tokens of its shards.
+"""
+import glob
+import hashlib
+import json
+import os
+import pickle
+import struct
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from log import log
+
+MAGIC = b'RQTOKENS'
+VERSION = 1
+HEADER_FORMAT = '<8sHHIQ32s'  # magic, version, dtype code, vocab size, number of tokens, sha256 of the tokens
+HEADER_SIZE = 64
+DTYPES = {1: np.dtype('<u2'), 2: np.dtype('<u4')}
+DEFAULT_SHARD_SIZE = 256 * 1024 * 1024  # in tokens
+
+
+def get_index_path(dir_path, name):
+    return f'{dir_path}/{name}.idx.json'
+
+
+def token_store_exists(dir_path, name):
+    return os.path.exists(get_index_path(dir_path, name))
+
+
+def remove_token_store(dir_path, name):
+    """removes the index and the shards of a token store, the index first so a store is never left half removed"""
+    index_path = get_index_path(dir_path, name)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    for shard_path in glob.glob(f'{glob.escape(dir_path)}/{glob.escape(name)}.[0-9][0-9][0-9][0-9][0-9].tokens'):
+        os.remove(shard_path)
+
+
+def get_dtype_for_vocab_size(vocab_size):
+    """returns the smallest dtype that can hold every token id of the vocabulary"""
+    return DTYPES[1] if vocab_size <= np.iinfo(np.uint16).max + 1 else DTYPES[2]
+
+
+def _get_dtype_code(dtype):
+    for code, code_dtype in DTYPES.items():
+        if code_dtype == np.dtype(dtype):
+            return code
+    raise ValueError(f'unsupported token dtype {dtype}: must be one of {list(DTYPES.values())}')
+
+
+def read_shard_header(shard_path):
+    """returns the dtype, vocab size, number of tokens and sha256 hex digest recorded in the header of a shard"""
+    with open(shard_path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        raise ValueError(f'{shard_path} is too short to be a token store shard')
+    magic, version, dtype_code, vocab_size, num_tokens, sha256 = struct.unpack_from(HEADER_FORMAT, header)
+    if magic != MAGIC:
+        raise ValueError(f'{shard_path} is not a token store shard')
+    if version > VERSION or dtype_code not in DTYPES:
+        raise ValueError(f'{shard_path} was written by a newer version of the token store (version {version})')
+    return DTYPES[dtype_code], vocab_size, num_tokens, sha256.hex()
+
+
+def _pack_shard_header(dtype, vocab_size, num_tokens, sha256):
+    header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, _get_dtype_code(dtype), vocab_size, num_tokens, sha256)
+    return header.ljust(HEADER_SIZE, b'\0')
+
+
+class TokenStoreWriter:
+    """
+    Writes tokens to a new token store, starting a new shard every shard_size tokens. The index is only written when
+    the writer is closed, so a partially written store is never picked up by TokenStore.
+    """
+
+    def __init__(self, dir_path, name, vocab_size, dtype=None, shard_size=DEFAULT_SHARD_SIZE):
+        self.dir_path = dir_path
+        self.name = name
+        self.vocab_size = vocab_size
+        self.dtype = np.dtype(dtype) if dtype is not None else get_dtype_for_vocab_size(vocab_size)
+        _get_dtype_code(self.dtype)
+        self.shard_size = shard_size
+        self.shards = []
+        self.shard_file = None
+        self.shard_num_tokens = 0
+        self.shard_sha256 = None
+        os.makedirs(dir_path, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.shard_file is not None:
+            self.shard_file.close()
+
+    def write(self, tokens):
+        tokens = np.asarray(tokens)
+        if len(tokens) > 0 and (tokens.min() < 0 or tokens.max() >= self.vocab_size):
+            raise ValueError(f'token ids must be in [0, {self.vocab_size})')
+        tokens = tokens.astype(self.dtype, copy=False)
+        while len(tokens) > 0:
+            if self.shard_file is None:
+                self._start_shard()
+            num_tokens = min(len(tokens), self.shard_size - self.shard_num_tokens)
+            data = tokens[:num_tokens].tobytes()
+            self.shard_file.write(data)
+            self.shard_sha256.update(data)
+            self.shard_num_tokens += num_tokens
+            tokens = tokens[num_tokens:]
+            if self.shard_num_tokens == self.shard_size:
+                self._finish_shard()
+
+    def close(self):
+        if self.shard_file is not None:
+            self._finish_shard()
+        index = {'version': VERSION,
+                 'dtype': self.dtype.str,
+                 'vocab_size': self.vocab_size,
+                 'num_tokens': sum(shard['num_tokens'] for shard in self.shards),
+                 'shards': self.shards}
+        index_path = get_index_path(self.dir_path, self.name)
+        with open(f'{index_path}.tmp', 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(f'{index_path}.tmp', index_path)
+        log.info(f'wrote {index["num_tokens"]} tokens to {len(self.shards)} shards of token store {index_path}')
+
+    def _start_shard(self):
+        file_name = f'{self.name}.{len(self.shards):05d}.tokens'
+        self.shard_file = open(f'{self.dir_path}/{file_name}', 'wb')
+        self.shard_file.write(b'\0' * HEADER_SIZE)  # the header is written when the shard is finished
+        self.shard_num_tokens = 0
+        self.shard_sha256 = hashlib.sha256()
+        self.shards.append({'file': file_name})
+
+    def _finish_shard(self):
+        self.shard_file.seek(0)
+        self.shard_file.write(_pack_shard_header(self.dtype, self.vocab_size, self.shard_num_tokens,
+                                                 self.shard_sha256.digest()))
+        self.shard_file.close()
+        self.shard_file = None
+        self.shards[-1].update({'num_tokens': self.shard_num_tokens, 'sha256': self.shard_sha256.hexdigest()})
+
+
+class TokenStore:
+    """
+    Read-only view of a token store that memory-maps its shards, so a store larger than memory can be used as if it
+    was one 1D array of tokens: it supports len(), integer and slice indexing (slices may cross shard boundaries) and
+    np.asarray(), which reads the whole store into memory.
+    """
+
+    def __init__(self, dir_path, name, verify=False):
+        """
+        :param verify: Whether to check the checksums of the shards, which reads all the tokens.
+        """
+        self.dir_path = dir_path
+        self.name = name
+        with open(get_index_path(dir_path, name)) as f:
+            index = json.load(f)
+        self.dtype = np.dtype(index['dtype'])
+        self.vocab_size = index['vocab_size']
+        self.num_tokens = index['num_tokens']
+        self.shards = []
+        for shard in index['shards']:
+            shard_path = f'{dir_path}/{shard["file"]}'
+            dtype, vocab_size, num_tokens, sha256 = read_shard_header(shard_path)
+            if dtype != self.dtype or num_tokens != shard['num_tokens'] or sha256 != shard['sha256']:
+                raise ValueError(f'header of {shard_path} does not match the index of token store {name}')
+            self.shards.append(np.memmap(shard_path, dtype=self.dtype, mode='r', offset=HEADER_SIZE,
+                                         shape=(num_tokens,)))
+        # the offset of the first token of each shard, followed by the total number of tokens
+        self.shard_starts = np.cumsum([0] + [len(shard) for shard in self.shards])
+        if self.shard_starts[-1] != self.num_tokens:
+            raise ValueError(f'the shards of token store {name} do not hold the {self.num_tokens} tokens of its index')
+        if verify:
+            self.verify()
+
+    def __reduce__(self):
+        # reopen the store instead of pickling the contents of the memory-mapped shards
+        return TokenStore, (self.dir_path, self.name)
+
+    def verify(self):
+        """:raises ValueError: if the tokens of a shard do not match the checksum in its header"""
+        for shard in self.shards:
+            sha256 = hashlib.sha256()
+            for start in range(0, len(shard), DEFAULT_SHARD_SIZE // 16):
+                sha256.update(shard[start:start + DEFAULT_SHARD_SIZE // 16].tobytes())
+            if sha256.hexdigest() != read_shard_header(shard.filename)[3]:
+                raise ValueError(f'checksum mismatch for {shard.filename}: the token store is corrupted')
+
+    def __len__(self):
+        return self.num_tokens
+
+    def __array__(self, dtype=None, copy=None):
+        tokens = self[0:self.num_tokens]
+        return tokens if dtype is None else tokens.astype(dtype, copy=False)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.num_tokens)
+            if step != 1:
+                raise IndexError('token store slices must be contiguous')
+            return self._read(start, max(stop - start, 0))
+        if index < 0:
+            index += self.num_tokens
+        if not 0 <= index < self.num_tokens:
+            raise IndexError('token index out of range')
+        shard_index = np.searchsorted(self.shard_starts, index, side='right') - 1
+        return self.shards[shard_index][index - self.shard_starts[shard_index]]
+
+    def _read(self, start, length):
+        """returns the length tokens from start, as a view of a shard if they do not cross a shard boundary"""
+        if length == 0:
+            return np.empty(0, dtype=self.dtype)
+        shard_index = np.searchsorted(self.shard_starts, start, side='right') - 1
+        shard_start = start - self.shard_starts[shard_index]
+        shard = self.shards[shard_index]
+        if shard_start + length <= len(shard):
+            return shard[shard_start:shard_start + length]
+        parts = []
+        while length > 0:
+            shard = self.shards[shard_index]
+            part = shard[shard_start:shard_start + length]
+            parts.append(part)
+            length -= len(part)
+            shard_index += 1
+            shard_start = 0
+        return np.concatenate(parts)
+
+    def gather(self, offsets, length):
+        """returns the windows of length tokens starting at each of the offsets as a 2D array"""
+        offsets = np.asarray(offsets, dtype=np.int64)
+        windows = np.empty((len(offsets), length), dtype=self.dtype)
+        shard_indices = np.searchsorted(self.shard_starts, offsets, side='right') - 1
+        for shard_index in np.unique(shard_indices):
+            shard = self.shards[shard_index]
+            in_shard = shard_indices == shard_index
+            shard_offsets = offsets[in_shard] - self.shard_starts[shard_index]
+            # windows that fit in the shard are gathered in one copy, the ones crossing into the next shard one by one
+            fits = shard_offsets + length <= len(shard)
+            rows = np.flatnonzero(in_shard)
+            if fits.any():
+                windows[rows[fits]] = sliding_window_view(shard, length)[shard_offsets[fits]]
+            for row in rows[~fits]:
+                windows[row] = self._read(offsets[row], length)
+        return windows
+
+
+def gather_windows(tokens, offsets, length):
+    """returns the windows of length tokens starting at each of the offsets of tokens (an array or a TokenStore)"""
+    if isinstance(tokens, TokenStore):
+        return tokens.gather(offsets, length)
+    # the window view is created on each call since it is free to create but expensive to pickle
+    return sliding_window_view(tokens, length)[offsets]
+
+
+def convert_bin_to_token_store(bin_path, meta_path, dir_path, name, shard_size=DEFAULT_SHARD_SIZE):
+    """
+    Convert a headerless uint16 .bin file (nanoGPT's format, with the vocabulary size in meta.pkl) to a token store.
+    """
+    with open(meta_path, 'rb') as f:
+        vocab_size = pickle.load(f)['vocab_size']
+    tokens = np.memmap(bin_path, dtype=np.uint16, mode='r')
+    with TokenStoreWriter(dir_path, name, vocab_size, shard_size=shard_size) as writer:
+        for start in range(0, len(tokens), shard_size):
+            writer.write(tokens[start:start + shard_size])
+    return TokenStore(dir_path, name)
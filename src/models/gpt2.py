@@ -71,6 +71,11 @@ class GPT2(ModelBase):
             output_attentions=None,
             output_hidden_states=None,
             return_dict=None):
+        # the batches hold the input ids in a compact dtype (see GPT2DataCollator): widen them on the device
+        if input_ids is not None and input_ids.dtype != torch.long:
+            input_ids = input_ids.long()
+        if labels is not None and labels.dtype != torch.long:
+            labels = labels.long()
         return self.get_model()(input_ids=input_ids,
                                 past_key_values=past_key_values,
                                 attention_mask=attention_mask,
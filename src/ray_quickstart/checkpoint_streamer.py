@@ -0,0 +1,52 @@
+"""
+Background thread for pulling checkpoints from the Ray worker while training is running.
+"""
+import threading
+
+from ray import logger
+
+
+class CheckpointStreamer(threading.Thread):
+    """
+    Polls the Ray worker for checkpoint directories and pulls each one to the local computer (driver) once it has been
+    finalized. A checkpoint is considered finalized when its size has not changed between two consecutive polls. Pulling
+    a checkpoint too early is harmless since the sync after training transfers whatever is still missing.
+    """
+
+    def __init__(self, syncer, poll_interval):
+        super().__init__(name='checkpoint-streamer', daemon=True)
+        self.syncer = syncer
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+        self.synced_checkpoint_dirs = set()
+        self.pending_checkpoint_dir_sizes = {}
+
+    def run(self):
+        logger.info(f'streaming checkpoints from ray worker every {self.poll_interval}s')
+        while not self.stop_event.wait(self.poll_interval):
+            try:
+                self.sync_finalized_checkpoints()
+            except Exception as e:
+                logger.error(f'error streaming checkpoints from ray worker: {e}')
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        logger.info(f'streamed {len(self.synced_checkpoint_dirs)} checkpoint(s) from ray worker during training')
+
+    def sync_finalized_checkpoints(self):
+        checkpoint_dir_sizes = self.syncer.get_ray_worker_checkpoint_dir_sizes()
+        for checkpoint_dir, size in checkpoint_dir_sizes.items():
+            if checkpoint_dir in self.synced_checkpoint_dirs or self.stop_event.is_set():
+                continue
+            if self.pending_checkpoint_dir_sizes.get(checkpoint_dir) == size:
+                logger.info(f'pulling finalized checkpoint {checkpoint_dir} from ray worker')
+                self.syncer.sync_checkpoint_dir_from_ray_worker_to_driver(checkpoint_dir)
+                self.synced_checkpoint_dirs.add(checkpoint_dir)
+                del self.pending_checkpoint_dir_sizes[checkpoint_dir]
+            else:
+                self.pending_checkpoint_dir_sizes[checkpoint_dir] = size
+        # forget about checkpoints that have been rotated out on the Ray worker
+        for checkpoint_dir in list(self.pending_checkpoint_dir_sizes.keys()):
+            if checkpoint_dir not in checkpoint_dir_sizes:
+                del self.pending_checkpoint_dir_sizes[checkpoint_dir]
@@ -0,0 +1,187 @@
+"""
+Node-local cache of the NumPy arrays and files that training data is built from, keyed by the hash of their contents.
+"""
+import hashlib
+import os
+
+import numpy as np
+import ray
+from ray import logger
+from ray.util.scheduling_strategies import NodeAffinitySchedulingStrategy
+
+DEFAULT_DATASET_CACHE_DIR = '~/.cache/ray_quickstart/datasets'
+MAX_CACHED_ARRAYS = 10
+MAX_CACHED_FILES_SIZE = 100 * 1024 * 1024 * 1024  # in bytes
+
+
+class CachedArray:
+    """
+    Reference to an array stored in the dataset cache of the nodes of the Ray cluster. It only holds the hash of the
+    array, so it is cheap to send to the Ray workers, which read the array from their node's cache with load().
+    """
+
+    def __init__(self, content_hash, cache_dir=DEFAULT_DATASET_CACHE_DIR):
+        self.content_hash = content_hash
+        self.cache_dir = cache_dir
+
+    def get_path(self):
+        return get_cached_array_path(self.content_hash, self.cache_dir)
+
+    def load(self):
+        """returns the array memory-mapped from the node's cache"""
+        path = self.get_path()
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'array {self.content_hash[:12]} is not in the dataset cache of this node: the '
+                                    f'node probably joined the cluster after the array was cached')
+        return np.load(path, mmap_mode='r')
+
+    def __str__(self):
+        return f'cached array {self.content_hash[:12]}'
+
+
+def cache_array_on_cluster(array, cache_dir=DEFAULT_DATASET_CACHE_DIR):
+    """
+    Make sure that the array is in the dataset cache of every node of the Ray cluster. The array is only sent to the
+    nodes that do not have it yet, so a repeat run on the same data does not move the data again.
+
+    :return: the CachedArray to send to the Ray workers instead of the array.
+    """
+    array = np.ascontiguousarray(array)
+    content_hash = compute_array_hash(array)
+    cached_array = CachedArray(content_hash, cache_dir)
+    node_ids = [node['NodeID'] for node in ray.nodes() if node['Alive']]
+    is_cached = ray.get([_is_cached.options(scheduling_strategy=_on_node(node_id)).remote(cached_array.get_path())
+                         for node_id in node_ids])
+    missing_node_ids = [node_id for node_id, node_is_cached in zip(node_ids, is_cached) if not node_is_cached]
+    if len(missing_node_ids) == 0:
+        logger.info(f'{cached_array} is already in the dataset cache of all {len(node_ids)} nodes: not sending it')
+        return cached_array
+    logger.info(f'sending {cached_array} ({array.nbytes / 1e6:.1f} MB) to the dataset cache of '
+                f'{len(missing_node_ids)} of {len(node_ids)} nodes...')
+    array_ref = ray.put(array)
+    ray.get([_store.options(scheduling_strategy=_on_node(node_id)).remote(cached_array, array_ref)
+             for node_id in missing_node_ids])
+    return cached_array
+
+
+def cache_files_on_cluster(files, cache_dir=DEFAULT_DATASET_CACHE_DIR):
+    """
+    Make sure that the files are in the dataset cache of every node of the Ray cluster, for data that is too large to be
+    sent as one array. Each file is only sent to the nodes that do not have it yet, one file at a time, so the memory
+    used on the driver is bounded by the size of the largest file instead of the size of the data.
+
+    :param files: A dict of the names of the files in the cache to their local path or to their contents as bytes. The
+           names must be derived from the contents of the files (e.g. their hash), since a file that is already in the
+           cache under the same name is not sent again.
+    :return: the directory of the cached files, to be expanded with get_cached_files_dir() on the nodes.
+    """
+    node_ids = [node['NodeID'] for node in ray.nodes() if node['Alive']]
+    file_names = list(files.keys())
+    missing_file_names = ray.get([_get_missing_files.options(scheduling_strategy=_on_node(node_id)).remote(cache_dir,
+                                                                                                           file_names)
+                                  for node_id in node_ids])
+    files_to_send = sorted({file_name for node_file_names in missing_file_names for file_name in node_file_names})
+    if len(files_to_send) == 0:
+        logger.info(f'the {len(files)} files are already in the dataset cache of all {len(node_ids)} nodes: not '
+                    f'sending them')
+        return cache_dir
+    for file_name in files_to_send:
+        missing_node_ids = [node_id for node_id, node_file_names in zip(node_ids, missing_file_names)
+                            if file_name in node_file_names]
+        contents = files[file_name]
+        if not isinstance(contents, bytes):
+            with open(contents, 'rb') as f:
+                contents = f.read()
+        logger.info(f'sending {file_name} ({len(contents) / 1e6:.1f} MB) to the dataset cache of '
+                    f'{len(missing_node_ids)} of {len(node_ids)} nodes...')
+        contents_ref = ray.put(contents)
+        del contents  # only one file is held in memory at a time
+        ray.get([_store_file.options(scheduling_strategy=_on_node(node_id)).remote(cache_dir, file_name, contents_ref)
+                 for node_id in missing_node_ids])
+        del contents_ref
+    ray.get([_prune_cached_files.options(scheduling_strategy=_on_node(node_id)).remote(cache_dir, file_names)
+             for node_id in node_ids])
+    return cache_dir
+
+
+def compute_array_hash(array):
+    sha256 = hashlib.sha256(f'{array.dtype.str}{array.shape}'.encode('utf-8'))
+    sha256.update(memoryview(np.ascontiguousarray(array)).cast('B'))
+    return sha256.hexdigest()
+
+
+def get_cached_array_path(content_hash, cache_dir=DEFAULT_DATASET_CACHE_DIR):
+    return f'{os.path.expanduser(cache_dir)}/{content_hash}.npy'
+
+
+def get_cached_files_dir(cache_dir=DEFAULT_DATASET_CACHE_DIR):
+    """returns the directory of the files cached by cache_files_on_cluster() on the current node"""
+    return f'{os.path.expanduser(cache_dir)}/files'
+
+
+def get_cached_file_path(file_name, cache_dir=DEFAULT_DATASET_CACHE_DIR):
+    return f'{get_cached_files_dir(cache_dir)}/{file_name}'
+
+
+def _on_node(node_id):
+    return NodeAffinitySchedulingStrategy(node_id=node_id, soft=False)
+
+
+@ray.remote(num_cpus=0)
+def _is_cached(path):
+    return _touch_if_exists(path)
+
+
+@ray.remote(num_cpus=0)
+def _get_missing_files(cache_dir, file_names):
+    return [file_name for file_name in file_names if not _touch_if_exists(get_cached_file_path(file_name, cache_dir))]
+
+
+def _touch_if_exists(path):
+    """marks the cached data as used, so it is pruned last"""
+    if os.path.exists(path):
+        os.utime(path)
+        return True
+    return False
+
+
+@ray.remote(num_cpus=0)
+def _store(cached_array, array):
+    path = cached_array.get_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+    _prune_cache(os.path.dirname(path))
+
+
+@ray.remote(num_cpus=0)
+def _store_file(cache_dir, file_name, contents):
+    path = get_cached_file_path(file_name, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(contents)
+    os.replace(tmp_path, path)
+
+
+@ray.remote(num_cpus=0)
+def _prune_cached_files(cache_dir, file_names_in_use, max_size=MAX_CACHED_FILES_SIZE):
+    """delete the least recently used files, except the ones in use, until the files fit in max_size"""
+    files_dir = get_cached_files_dir(cache_dir)
+    file_names = [file_name for file_name in os.listdir(files_dir) if not file_name.endswith('.tmp')]
+    file_names.sort(key=lambda file_name: os.path.getmtime(f'{files_dir}/{file_name}'), reverse=True)
+    size = 0
+    for file_name in file_names:
+        size += os.path.getsize(f'{files_dir}/{file_name}')
+        if size > max_size and file_name not in file_names_in_use:
+            os.remove(f'{files_dir}/{file_name}')
+
+
+def _prune_cache(cache_dir, max_arrays=MAX_CACHED_ARRAYS):
+    """delete all but the most recently used arrays"""
+    paths = [f'{cache_dir}/{file_name}' for file_name in os.listdir(cache_dir) if file_name.endswith('.npy')]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for path in paths[max_arrays:]:
+        os.remove(path)
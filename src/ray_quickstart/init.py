@@ -1,6 +1,8 @@
 """
 Utilities for working with Ray.
 """
+from concurrent.futures import ThreadPoolExecutor, wait
+import hashlib
 import os
 import shutil
 import subprocess
@@ -11,9 +13,16 @@ import yaml
 
 from ray_quickstart.monkey_patch import monkey_patch_base_trainer_to_enable_syncing_after_training, \
     monkey_patch_trainable_util_to_fix_checkpoint_paths
+from ray_quickstart.packaging import build_working_dir_package, DEFAULT_WORKING_DIR_EXCLUDES
+from ray_quickstart.remote_session import RemoteSession
 from ray_quickstart.rsync_syncer import RsyncSyncer
 from ray_quickstart.util import platform
 from ray_quickstart.util.platform import normalize_home_path_for_platform
+from ray_quickstart.util.startup_profiler import STARTUP_PROFILE_FILE_NAME, StartupProfiler
+from ray_quickstart.util.trash import move_dir_to_trash, start_trash_reaper
+
+ENVIRONMENT_FILES = ('Pipfile', 'requirements.txt')
+ENVIRONMENT_FINGERPRINT_FILE = '.ray_quickstart_environment_fingerprint'
 
 
 def initialize_ray_with_syncer(base_dir,
@@ -22,7 +31,12 @@ def initialize_ray_with_syncer(base_dir,
                                ray_config_file_path,
                                trial_results_dir,
                                success_callback=None,
-                               clean_trial_results_dir_at_start=True):
+                               clean_trial_results_dir_at_start=True,
+                               force_environment_setup=False,
+                               log_startup_profile=False,
+                               overlap_init=False,
+                               package_working_dir=True,
+                               working_dir_excludes=DEFAULT_WORKING_DIR_EXCLUDES):
     """
     :param base_dir: The base directory of your project.
     :param src_dir: The base directory for your Python source code
@@ -32,9 +46,16 @@ def initialize_ray_with_syncer(base_dir,
            will do the platform-dependent path expansion for you.
     :param success_callback: Callback to call when Ray is successfully initialized.
     :param clean_trial_results_dir_at_start: Whether to clean the trial results directory on your local computer and the remote computer at the start of the experiment.
+    :param force_environment_setup: Whether to copy the environment files and run the setup commands on the remote computer even if they have not changed since the last setup.
+    :param log_startup_profile: Whether to log the wall time of each initialization phase as a table. The startup profile is always available as syncer.startup_report and written to startup_profile.json in the trial results directory.
+    :param overlap_init: Whether to run the independent initialization phases concurrently: cleaning the remote trial results directory and configuring the remote runtime environment. The local trial results directory is cleaned first (it is only renamed), so that the remote phases are not started if it fails, as in the sequential initialization. Ray is initialized once they have all finished.
+    :param package_working_dir: Whether to upload src_dir as a content-addressed zip package that is reused as long as the source code does not change (see initialize_ray()).
+    :param working_dir_excludes: The glob patterns of the files and directories in src_dir that are not uploaded.
     :return: an RsyncSyncer object that needs to be called after training to sync the checkpoints from the remote computer to the local computer.
     """
-    ray_config = load_ray_config(ray_config_file_path)
+    profiler = StartupProfiler()
+    with profiler.phase('config_load'):
+        ray_config = load_ray_config(ray_config_file_path)
     driver_user = ray_config['driver']['user']
     driver_private_key_file = ray_config['driver']['private_key_file']
     worker_user = ray_config['worker']['user']
@@ -43,37 +64,67 @@ def initialize_ray_with_syncer(base_dir,
     worker_platform = ray_config['worker']['platform']
     worker_base_dir = 'base_dir' in ray_config['worker'] and ray_config['worker']['base_dir'] or base_dir
     worker_setup_commands = ray_config['worker']['setup_commands']
+    sync_config = ray_config.get('sync') or {}
+    session = RemoteSession(worker_user, worker_hostname_or_ip_address, worker_ssh_port, driver_private_key_file)
     syncer = RsyncSyncer(driver_user,
                          driver_private_key_file,
                          worker_user,
                          worker_hostname_or_ip_address,
                          worker_ssh_port,
                          worker_platform,
-                         trial_results_dir)
+                         trial_results_dir,
+                         max_parallel_transfers=sync_config.get('max_parallel_transfers', 1),
+                         stream_checkpoints_interval=sync_config.get('stream_checkpoints_interval'),
+                         checkpoints_to_sync=sync_config.get('checkpoints', 'all'),
+                         session=session)
     if ray.is_initialized():
         return syncer
-    monkey_patch_base_trainer_to_enable_syncing_after_training()
+    with profiler.phase('monkey_patches'):
+        monkey_patch_base_trainer_to_enable_syncing_after_training()
     try:
-        if clean_trial_results_dir_at_start:
-            clean_trial_results_dir(syncer, trial_results_dir)
-        configure_remote_ray_runtime_environment(base_dir,
-                                                 driver_private_key_file,
-                                                 worker_user,
-                                                 worker_hostname_or_ip_address,
-                                                 worker_ssh_port,
-                                                 worker_platform,
-                                                 worker_base_dir,
-                                                 worker_setup_commands)
-        initialize_ray(src_dir, env_vars, ray_config_file_path, ray_config, trial_results_dir, success_callback)
-        return syncer
+        if overlap_init:
+            if clean_trial_results_dir_at_start:
+                # an error here stops the initialization before anything is changed on the Ray worker
+                clean_local_trial_results_dir(trial_results_dir, profiler)
+            with ThreadPoolExecutor(max_workers=2, thread_name_prefix='ray-init') as executor:
+                futures = []
+                if clean_trial_results_dir_at_start:
+                    futures.append(executor.submit(clean_ray_worker_trial_results_dir, syncer, profiler))
+                futures.append(executor.submit(configure_remote_ray_runtime_environment,
+                                               base_dir,
+                                               session,
+                                               worker_platform,
+                                               worker_base_dir,
+                                               worker_setup_commands,
+                                               force_setup=force_environment_setup,
+                                               profiler=profiler))
+                # wait for all the phases and raise the first error in the same order as the sequential initialization
+                wait(futures)
+                for future in futures:
+                    future.result()
+        else:
+            if clean_trial_results_dir_at_start:
+                clean_trial_results_dir(syncer, trial_results_dir, profiler)
+            configure_remote_ray_runtime_environment(base_dir,
+                                                     session,
+                                                     worker_platform,
+                                                     worker_base_dir,
+                                                     worker_setup_commands,
+                                                     force_setup=force_environment_setup,
+                                                     profiler=profiler)
+        initialize_ray(src_dir, env_vars, ray_config_file_path, ray_config, trial_results_dir, success_callback, profiler,
+                           package_working_dir, working_dir_excludes)
     except ConnectionError:
         if platform.is_windows() and os.path.exists(f'{base_dir}/scripts/ray_start.bat'):
-            with subprocess.Popen(f'{base_dir}/scripts/ray_start.bat') as p:
-                p.wait()
-            initialize_ray(src_dir, env_vars, ray_config_file_path, ray_config, trial_results_dir, success_callback)
-            return syncer
+            with profiler.phase('ray_start'):
+                with subprocess.Popen(f'{base_dir}/scripts/ray_start.bat') as p:
+                    p.wait()
+            initialize_ray(src_dir, env_vars, ray_config_file_path, ray_config, trial_results_dir, success_callback, profiler,
+                               package_working_dir, working_dir_excludes)
         else:
             raise
+    syncer.startup_report = report_startup_profile(profiler, trial_results_dir, driver_user, log_startup_profile)
+    return syncer
 
 
 def initialize_ray(src_dir,
@@ -81,20 +132,57 @@ def initialize_ray(src_dir,
                    ray_config_file_path,
                    ray_config=None,
                    trial_results_dir='~/ray_results',
-                   success_callback=None):
+                   success_callback=None,
+                   profiler=None,
+                   package_working_dir=True,
+                   working_dir_excludes=DEFAULT_WORKING_DIR_EXCLUDES):
+    """
+    :param profiler: The StartupProfiler used to record the wall time of each phase.
+    :param package_working_dir: Whether to package src_dir into a deterministic zip file keyed by the hash of its
+           contents before passing it to Ray as the working_dir. Unchanged source code yields the same package, which
+           Ray does not upload again if the cluster still has it. If False, Ray zips and uploads src_dir itself.
+    :param working_dir_excludes: The glob patterns of the files and directories in src_dir that are not uploaded.
+    :return: the startup report of the profiler or None if Ray was already initialized.
+    """
     if ray.is_initialized():
-        return
+        return None
+    if profiler is None:
+        profiler = StartupProfiler()
     if ray_config is None:
-        ray_config = load_ray_config(ray_config_file_path)
-    runtime_env = {'working_dir': src_dir,  # working_dir is required for cloudpickle to be able to find modules
-                   'output_dir': trial_results_dir,
-                   'env_vars' : env_vars}
+        with profiler.phase('config_load'):
+            ray_config = load_ray_config(ray_config_file_path)
+    if package_working_dir:
+        with profiler.phase('working_dir_package'):
+            working_dir = build_working_dir_package(src_dir, working_dir_excludes)
+        runtime_env = {'working_dir': working_dir}  # working_dir is required for cloudpickle to be able to find modules
+    else:
+        runtime_env = {'working_dir': src_dir,  # working_dir is required for cloudpickle to be able to find modules
+                       'excludes': list(working_dir_excludes or [])}
+    runtime_env['output_dir'] = trial_results_dir
+    runtime_env['env_vars'] = env_vars
     ray_head_hostname_or_ip_address = ray_config['ray_head']['hostname_or_ip_address']
     ray_head_client_server_port = ray_config['ray_head']['client_server_port']
-    ray.init(address=f'ray://{ray_head_hostname_or_ip_address}:{ray_head_client_server_port}', runtime_env=runtime_env)
-    monkey_patch_trainable_util_to_fix_checkpoint_paths()
+    # the working_dir is uploaded (and zipped if it is not packaged already) as part of ray.init()
+    with profiler.phase('ray_init'):
+        ray.init(address=f'ray://{ray_head_hostname_or_ip_address}:{ray_head_client_server_port}', runtime_env=runtime_env)
+    with profiler.phase('monkey_patches'):
+        monkey_patch_trainable_util_to_fix_checkpoint_paths()
     if success_callback is not None:
         success_callback()
+    return profiler.get_report()
+
+
+def report_startup_profile(profiler, trial_results_dir, driver_user=None, log_startup_profile=False):
+    """Write the startup report as JSON to the local trial results dir and optionally log it as a table."""
+    report = profiler.get_report()
+    trial_results_dir = os.path.expanduser(normalize_home_path_for_platform(trial_results_dir, driver_user, None))
+    try:
+        profiler.write_json(f'{trial_results_dir}/{STARTUP_PROFILE_FILE_NAME}', report)
+    except OSError as e:
+        logger.warning(f'error writing startup profile to {trial_results_dir}: {e}')
+    if log_startup_profile:
+        profiler.log_table(report)
+    return report
 
 
 def load_ray_config(config_file_path):
@@ -105,48 +193,111 @@ def load_ray_config(config_file_path):
     return ray_config
 
 
-def clean_trial_results_dir(syncer, trial_results_dir):
-    logger.info('cleaning local trial results dir...')
-    trial_results_dir = os.path.expanduser(trial_results_dir)
-    if os.path.exists(trial_results_dir):
-        delete_dir_contents(trial_results_dir)
-    else:
-        os.makedirs(trial_results_dir, exist_ok=True)
+def clean_trial_results_dir(syncer, trial_results_dir, profiler=None):
+    """
+    Empty the trial results dir on the local computer and the Ray worker by renaming it to a trash directory on both
+    sides. The trash directories are deleted in the background, so this does not wait for old trials to be deleted.
+    """
+    clean_local_trial_results_dir(trial_results_dir, profiler)
     if syncer is not None:
-        logger.info('cleaning ray worker trial results dir...')
-        syncer.sync_from_driver_to_ray_worker()
+        clean_ray_worker_trial_results_dir(syncer, profiler)
+
+
+def clean_local_trial_results_dir(trial_results_dir, profiler=None):
+    if profiler is None:
+        profiler = StartupProfiler()
+    logger.info('cleaning local trial results dir...')
+    with profiler.phase('local_clean'):
+        trial_results_dir = os.path.expanduser(trial_results_dir).rstrip('/')
+        move_dir_to_trash(trial_results_dir)
+        start_trash_reaper(trial_results_dir)
+
+
+def clean_ray_worker_trial_results_dir(syncer, profiler=None):
+    if profiler is None:
+        profiler = StartupProfiler()
+    logger.info('cleaning ray worker trial results dir...')
+    with profiler.phase('remote_clean'):
+        syncer.clean_ray_worker_trial_results_dir()
 
 
 def configure_remote_ray_runtime_environment(base_dir,
-                                             driver_private_key_file,
-                                             worker_user,
-                                             worker_hostname_or_ip_address,
-                                             worker_ssh_port,
+                                             session,
                                              worker_platform,
                                              worker_base_dir,
-                                             worker_setup_commands):
-    worker_base_dir = normalize_home_path_for_platform(worker_base_dir, worker_user, worker_platform)
-    os.system(f'ssh-keygen -R {worker_hostname_or_ip_address} 2>/dev/null')
-    sync_cmd = f'rsync -avz -e "ssh -i {driver_private_key_file} -o StrictHostKeyChecking=no -o LogLevel=ERROR -p {worker_ssh_port}" --include="Pipfile" --include="requirements.txt" --exclude="*" {base_dir}/ {worker_user}@{worker_hostname_or_ip_address}:{worker_base_dir}/'
+                                             worker_setup_commands,
+                                             force_setup=False,
+                                             profiler=None):
+    """
+    Copy the environment files to the Ray worker and run the setup commands there. The setup is skipped if the
+    fingerprint of the environment files and setup commands matches the one stored on the Ray worker by the last
+    successful setup.
+
+    :param session: The RemoteSession used to connect to the Ray worker.
+    :param force_setup: Whether to run the setup even if the environment fingerprint is unchanged.
+    :param profiler: The StartupProfiler used to record the wall time of each phase.
+    """
+    if profiler is None:
+        profiler = StartupProfiler()
+    worker_base_dir = normalize_home_path_for_platform(worker_base_dir, session.user, worker_platform)
+    fingerprint = compute_environment_fingerprint(base_dir, worker_setup_commands)
+    with profiler.phase('environment_fingerprint'):
+        remote_fingerprint = get_remote_environment_fingerprint(session, worker_base_dir)
+    if not force_setup and remote_fingerprint == fingerprint:
+        logger.info(f'remote Ray runtime environment is up to date (fingerprint {fingerprint[:12]}): skipping setup')
+        return
+    includes = ' '.join(f'--include="{filename}"' for filename in ENVIRONMENT_FILES)
+    sync_cmd = f'rsync -avz -e "{session.get_ssh_cmd()}" {includes} --exclude="*" {base_dir}/ {session.get_remote_path(worker_base_dir)}/'
     logger.info(f'copying runtime environment configuration files to remote Ray runtime with command "{sync_cmd}"')
+    is_synced = True
     try:
-        output = str(subprocess.check_output(sync_cmd, shell=True)).replace('\\n', '\n')
+        with profiler.phase('dependency_rsync'):
+            output = str(subprocess.check_output(sync_cmd, shell=True)).replace('\\n', '\n')
         logger.info(output)
     except subprocess.CalledProcessError as e:
+        is_synced = False
         logger.error(f'error copying runtime environment configuration files to remote Ray runtime with command "{sync_cmd}": {e}')
 
-    if worker_setup_commands is not None and len(worker_setup_commands) > 0:
-        worker_setup_commands.insert(0, f'cd {worker_base_dir}')
-        setup_commands = ' && '.join(worker_setup_commands)
+    setup_commands = [f'cd {worker_base_dir}'] + list(worker_setup_commands or [])
+    if is_synced:
+        # only reached if all the setup commands succeed
+        setup_commands.append(f'echo {fingerprint} > {ENVIRONMENT_FINGERPRINT_FILE}')
+    if len(setup_commands) > 1:
+        setup_commands = ' && '.join(setup_commands)
         try:
-            configure_cmd = f'ssh -i {driver_private_key_file} -o StrictHostKeyChecking=no -o LogLevel=ERROR -p {worker_ssh_port} {worker_user}@{worker_hostname_or_ip_address} "{setup_commands}"'
             logger.info(f'configuring remote Ray runtime environment with command "{setup_commands}"')
-            output = str(subprocess.check_output(configure_cmd, shell=True)).replace('\\n', '\n')
+            with profiler.phase('setup_commands'):
+                output = session.run(setup_commands)
             logger.info(output)
         except subprocess.CalledProcessError as e:
             logger.error(f'error configuring remote Ray runtime environment with command "{setup_commands}": {e}')
 
 
+def compute_environment_fingerprint(base_dir, worker_setup_commands):
+    """returns a hash of the contents of the environment files and of the setup commands"""
+    sha256 = hashlib.sha256()
+    for filename in ENVIRONMENT_FILES:
+        sha256.update(f'{filename}\0'.encode('utf-8'))
+        file_path = f'{base_dir}/{filename}'
+        if os.path.exists(file_path):
+            with open(file_path, 'rb') as f:
+                sha256.update(f.read())
+        sha256.update(b'\0')
+    for command in worker_setup_commands or []:
+        sha256.update(f'{command}\0'.encode('utf-8'))
+    return sha256.hexdigest()
+
+
+def get_remote_environment_fingerprint(session, worker_base_dir):
+    """returns the environment fingerprint stored on the Ray worker or None if there is none"""
+    try:
+        fingerprint = session.run(f'cat {worker_base_dir}/{ENVIRONMENT_FINGERPRINT_FILE} 2>/dev/null || true').strip()
+    except subprocess.CalledProcessError as e:
+        logger.warning(f'error reading remote Ray runtime environment fingerprint: {e}')
+        return None
+    return fingerprint or None
+
+
 def delete_dir_contents(dir_path):
     for filename in os.listdir(dir_path):
         file_path = os.path.join(dir_path, filename)
@@ -1,7 +1,6 @@
 import os
 import sys
 
-import numpy as np
 from ray import logger
 
 
@@ -28,7 +27,7 @@ def monkey_patch_cloudpickle_fast():
 
 
 def monkey_patch_base_trainer_to_enable_syncing_after_training():
-    """Monkey-patch ray.train.base_trainer.BaseTrainer so we can't sync the checkpoints before retrieving the grid results so that the checkpoints are available locally."""
+    """Monkey-patch ray.train.base_trainer.BaseTrainer so we can't sync the checkpoints before retrieving the grid results so that the checkpoints are available locally. Checkpoints are also streamed back during training if the syncer is configured to do so."""
 
     from pathlib import Path
     from ray.train.base_trainer import BaseTrainer
@@ -78,6 +77,8 @@ def monkey_patch_base_trainer_to_enable_syncing_after_training():
             path=str(experiment_path),
         )
 
+        if syncer is not None:
+            syncer.start_streaming_checkpoints()
         try:
             result_grid = tuner.fit()
         except TuneError as e:
@@ -87,12 +88,15 @@ def monkey_patch_base_trainer_to_enable_syncing_after_training():
 
             # Raise it to the user as a `TrainingFailedError` with a message to restore.
             raise TrainingFailedError(restore_msg) from parent_error
+        finally:
+            if syncer is not None:
+                syncer.stop_streaming_checkpoints()
         # Other exceptions get passed through directly (ex: on `fail_fast='raise'`)
 
         assert len(result_grid) == 1
-        if syncer is not None:
-            syncer.sync_from_ray_worker_to_driver()
         result = result_grid[0]
+        if syncer is not None:
+            syncer.sync_result_from_ray_worker_to_driver(result, self.run_config.checkpoint_config)
         if result.error:
             # Raise trainable errors to the user with a message to restore
             # or configure `FailureConfig` in a new run.
@@ -104,20 +108,6 @@ def monkey_patch_base_trainer_to_enable_syncing_after_training():
     BaseTrainer.fit = fit
 
 
-def monkey_patch_huggingface_utils_to_process_datasets_for_gpt2():
-    """Monkey-patch huggingface.utils to convert the NumPy arrays into labelled examples for GPT2 training"""
-    from ray.train.huggingface._huggingface_utils import RayDatasetHFIterable
-
-    def __iter__(self):
-        for row in self.generate_examples_fn(**self.kwargs):
-            example = (0, {'input_ids': row[0:len(row)-1].astype(np.int64),
-                           'labels': row[1:len(row)].astype(np.int64)}
-                       )
-            yield example
-
-    RayDatasetHFIterable.__iter__ = __iter__
-
-
 def monkey_patch_trainable_util_to_fix_checkpoint_paths():
     """Monkey-patch ray.tune.trainable.util.TrainableUtil to fix the checkpoint path in the home directory so the path is correct when transferred from the Ray worker to the driver"""
     from ray.tune.trainable.util import TrainableUtil
@@ -0,0 +1,103 @@
+"""
+Packaging of the working_dir that is uploaded to the Ray cluster.
+"""
+import fnmatch
+import hashlib
+import os
+import stat
+import zipfile
+
+from ray import logger
+
+DEFAULT_WORKING_DIR_EXCLUDES = ('__pycache__', '*.pyc', '.git', '.idea', '.pytest_cache', '.mypy_cache', '*.egg-info',
+                                '.DS_Store')
+DEFAULT_PACKAGE_CACHE_DIR = '~/.cache/ray_quickstart/packages'
+MAX_CACHED_PACKAGES = 5
+LARGE_PACKAGE_SIZE = 100 * 1024 * 1024  # Ray refuses working_dir packages above this size by default
+
+
+def build_working_dir_package(src_dir, excludes=DEFAULT_WORKING_DIR_EXCLUDES, cache_dir=DEFAULT_PACKAGE_CACHE_DIR):
+    """
+    Build a zip file of src_dir named after the hash of its contents. The zip file is deterministic (sorted entries and
+    fixed timestamps), so an unchanged src_dir produces a byte-identical package: it is reused from the cache instead of
+    being rebuilt and Ray, which names uploaded packages after the hash of the zip file, skips uploading it again when
+    the package is still in the cluster.
+
+    :param excludes: The glob patterns of the files and directories to leave out, matched against each path component
+           and against the path relative to src_dir.
+    :return: the path of the zip file.
+    """
+    src_dir = os.path.expanduser(src_dir)
+    cache_dir = os.path.expanduser(cache_dir)
+    file_paths = list_package_files(src_dir, excludes)
+    content_hash = compute_package_hash(src_dir, file_paths)
+    package_path = f'{cache_dir}/working_dir_{content_hash}.zip'
+    if os.path.exists(package_path):
+        os.utime(package_path)
+        logger.info(f'reusing working_dir package {package_path}')
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_package(src_dir, file_paths, package_path)
+        prune_package_cache(cache_dir)
+    package_size = os.path.getsize(package_path)
+    logger.info(f'working_dir package for {src_dir}: {len(file_paths)} files, {package_size / 1e6:.2f} MB '
+                f'(hash {content_hash[:12]})')
+    if package_size > LARGE_PACKAGE_SIZE:
+        logger.warning(f'working_dir package is {package_size / 1e6:.0f} MB: check for data or build artifacts in '
+                       f'{src_dir} or add them to the excludes')
+    return package_path
+
+
+def list_package_files(src_dir, excludes=DEFAULT_WORKING_DIR_EXCLUDES):
+    """returns the sorted paths relative to src_dir (with / separators) of the files to include in the package"""
+    file_paths = []
+    for dir_path, dir_names, file_names in os.walk(src_dir):
+        relative_dir_path = os.path.relpath(dir_path, src_dir).replace(os.sep, '/')
+        if relative_dir_path == '.':
+            relative_dir_path = ''
+        dir_names[:] = [dir_name for dir_name in dir_names
+                        if not _is_excluded(f'{relative_dir_path}/{dir_name}'.lstrip('/'), excludes)]
+        for file_name in file_names:
+            file_path = f'{relative_dir_path}/{file_name}'.lstrip('/')
+            if not _is_excluded(file_path, excludes):
+                file_paths.append(file_path)
+    return sorted(file_paths)
+
+
+def _is_excluded(path, excludes):
+    for pattern in excludes or ():
+        if fnmatch.fnmatch(path, pattern) or any(fnmatch.fnmatch(part, pattern) for part in path.split('/')):
+            return True
+    return False
+
+
+def compute_package_hash(src_dir, file_paths):
+    sha256 = hashlib.sha256()
+    for file_path in file_paths:
+        sha256.update(f'{file_path}\0'.encode('utf-8'))
+        with open(f'{src_dir}/{file_path}', 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        sha256.update(b'\0')
+    return sha256.hexdigest()
+
+
+def write_package(src_dir, file_paths, package_path):
+    tmp_package_path = f'{package_path}.{os.getpid()}.tmp'
+    with zipfile.ZipFile(tmp_package_path, 'w', zipfile.ZIP_DEFLATED) as package:
+        for file_path in file_paths:
+            zip_info = zipfile.ZipInfo(file_path, date_time=(1980, 1, 1, 0, 0, 0))
+            zip_info.compress_type = zipfile.ZIP_DEFLATED
+            zip_info.external_attr = (stat.S_IMODE(os.stat(f'{src_dir}/{file_path}').st_mode) | stat.S_IFREG) << 16
+            with open(f'{src_dir}/{file_path}', 'rb') as f:
+                package.writestr(zip_info, f.read())
+    os.replace(tmp_package_path, package_path)
+
+
+def prune_package_cache(cache_dir, max_packages=MAX_CACHED_PACKAGES):
+    """delete all but the most recently used packages"""
+    package_paths = [f'{cache_dir}/{file_name}' for file_name in os.listdir(cache_dir)
+                     if file_name.startswith('working_dir_') and file_name.endswith('.zip')]
+    package_paths.sort(key=os.path.getmtime, reverse=True)
+    for package_path in package_paths[max_packages:]:
+        os.remove(package_path)
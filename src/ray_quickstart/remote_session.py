@@ -0,0 +1,134 @@
+"""
+SSH session to the Ray worker that is shared by all the remote operations.
+"""
+import atexit
+import shlex
+import subprocess
+import threading
+import time
+
+from ray import logger
+
+from ray_quickstart.util import platform
+
+
+class RemoteSession:
+    """
+    Runs ssh commands and provides the ssh command used by rsync for the Ray worker. When multiplexing is enabled, a
+    single OpenSSH master connection (ControlMaster) is opened and every later command reuses it, so only the first
+    operation pays for the TCP and SSH handshake. Keep the number of concurrent operations below the MaxSessions setting
+    of the worker's sshd (10 by default).
+    """
+
+    def __init__(self,
+                 user,
+                 hostname,
+                 ssh_port,
+                 private_key_file,
+                 use_multiplexing=None,
+                 control_persist=600,
+                 known_hosts_file=None):
+        """
+        :param use_multiplexing: Whether to share one master connection between commands. Defaults to True except on
+               Windows, where OpenSSH does not support ControlMaster.
+        :param control_persist: The number of seconds the master connection stays open after the last command.
+        :param known_hosts_file: The known hosts file where the stale host key of the worker is forgotten and its new
+               host key is recorded. Defaults to the user's known hosts file (~/.ssh/known_hosts).
+        """
+        self.user = user
+        self.hostname = hostname
+        self.ssh_port = ssh_port
+        self.private_key_file = private_key_file
+        if use_multiplexing is None:
+            use_multiplexing = not platform.is_windows()
+        self.use_multiplexing = use_multiplexing
+        self.control_persist = control_persist
+        self.known_hosts_file = known_hosts_file
+        self.control_path = '~/.ssh/ray-quickstart-%C'
+        self.is_open = False
+        self.lock = threading.Lock()
+
+    def open(self):
+        """Forget the stale host key for the worker and start the master connection (only done once per session)."""
+        with self.lock:
+            self._open()
+
+    def _open(self):
+        if self.is_open:
+            return
+        known_hosts_option = self.known_hosts_file is not None and f' -f {self.known_hosts_file}' or ''
+        subprocess.run(f'ssh-keygen -R {self.hostname}{known_hosts_option}', shell=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if self.use_multiplexing:
+            # the master connection is started in the background with its output detached, otherwise the pipes of the
+            # command that started it would be held open for as long as the master is alive
+            master_cmd = f'{self._get_base_ssh_cmd()} -o ControlMaster=yes -o ControlPath={self.control_path} ' \
+                         f'-o ControlPersist={self.control_persist} -f -N {self.get_destination()}'
+            result = subprocess.run(master_cmd, shell=True, stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if result.returncode != 0:
+                logger.warning(f'unable to open shared ssh connection to {self.get_destination()}: falling back to '
+                               f'one connection per command')
+                self.use_multiplexing = False
+            else:
+                atexit.register(self.close)
+        self.is_open = True
+
+    def close(self):
+        """Stop the master connection."""
+        if not self.is_open:
+            return
+        if self.use_multiplexing:
+            subprocess.run(f'{self.get_ssh_cmd()} -O exit {self.get_destination()}', shell=True,
+                           stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.is_open = False
+
+    def get_destination(self):
+        return f'{self.user}@{self.hostname}'
+
+    def get_remote_path(self, path):
+        return f'{self.get_destination()}:{path}'
+
+    def get_ssh_cmd(self):
+        """returns the ssh command (without the destination) to use for ssh and for rsync's -e option"""
+        if not self.use_multiplexing:
+            return self._get_base_ssh_cmd()
+        # ControlMaster=no uses the master connection if it is alive and connects directly otherwise
+        return f'{self._get_base_ssh_cmd()} -o ControlMaster=no -o ControlPath={self.control_path}'
+
+    def _get_base_ssh_cmd(self):
+        ssh_cmd = f'ssh -i {self.private_key_file} -o StrictHostKeyChecking=no -o LogLevel=ERROR -p {self.ssh_port}'
+        if self.known_hosts_file is not None:
+            ssh_cmd += f' -o UserKnownHostsFile={self.known_hosts_file}'
+        return ssh_cmd
+
+    def run(self, command):
+        """
+        Run a shell command on the Ray worker.
+
+        :return: the output of the command.
+        :raises subprocess.CalledProcessError: if the command fails.
+        """
+        self.open()
+        # quoted for the local shell, so the command reaches the remote shell as is
+        return subprocess.check_output(f'{self.get_ssh_cmd()} {self.get_destination()} {shlex.quote(command)}',
+                                       shell=True).decode('utf-8')
+
+    def measure_connection_overhead(self, num_commands=5):
+        """
+        Compare the latency of running a no-op command through the shared connection with the latency of opening a new
+        connection for each command (the behavior without multiplexing).
+
+        :return: a dict with the average seconds per command for 'shared_connection' and 'connection_per_command'.
+        """
+        self.open()
+        timings = {}
+        for name, ssh_cmd in (('shared_connection', self.get_ssh_cmd()),
+                              ('connection_per_command', f'{self._get_base_ssh_cmd()} -o ControlPath=none')):
+            start_time = time.monotonic()
+            for _ in range(num_commands):
+                subprocess.check_output(f'{ssh_cmd} {self.get_destination()} true', shell=True)
+            timings[name] = (time.monotonic() - start_time) / num_commands
+        logger.info(f'ssh latency to {self.get_destination()}: {timings["shared_connection"]:.3f}s per command with a '
+                    f'shared connection vs {timings["connection_per_command"]:.3f}s with one connection per command')
+        return timings
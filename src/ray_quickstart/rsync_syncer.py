@@ -1,9 +1,39 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
 import subprocess
 import sys
+import time
 
 from ray import logger
 
+from ray_quickstart.checkpoint_streamer import CheckpointStreamer
+from ray_quickstart.remote_session import RemoteSession
 from ray_quickstart.util.platform import normalize_home_path_for_platform
+from ray_quickstart.util.startup_profiler import STARTUP_PROFILE_FILE_NAME
+from ray_quickstart.util.trash import TRASH_SUFFIX
+
+# files that only exist on the local computer and must not be deleted when syncing from the Ray worker
+PROTECT_FILTERS = f'--filter="P /{STARTUP_PROFILE_FILE_NAME}"'
+
+
+class SyncResult:
+    """Summary of a sync from the Ray worker to the local computer (driver)."""
+
+    def __init__(self, num_transfers, bytes_transferred, wall_time):
+        self.num_transfers = num_transfers
+        self.bytes_transferred = bytes_transferred
+        self.wall_time = wall_time
+
+    def get_throughput(self):
+        """returns the throughput in bytes per second"""
+        if self.wall_time <= 0:
+            return 0
+        return self.bytes_transferred / self.wall_time
+
+    def __str__(self):
+        return f'{self.num_transfers} transfer(s), {self.bytes_transferred / 1e6:.1f} MB in {self.wall_time:.1f}s ' \
+               f'({self.get_throughput() / 1e6:.1f} MB/s)'
 
 
 class RsyncSyncer:
@@ -15,7 +45,24 @@ class RsyncSyncer:
                  worker_hostname,
                  worker_ssh_port,
                  worker_platform,
-                 trial_results_dir):
+                 trial_results_dir,
+                 max_parallel_transfers=1,
+                 stream_checkpoints_interval=None,
+                 checkpoints_to_sync='all',
+                 session=None):
+        """
+        :param max_parallel_transfers: The maximum number of concurrent rsync transfers to use when syncing from the Ray
+               worker to the local computer. If greater than 1, the trial results dir is split into one transfer per
+               checkpoint directory plus one transfer for everything else.
+        :param stream_checkpoints_interval: If set, the number of seconds between polls of the Ray worker for new
+               checkpoints while training is running. Each checkpoint is pulled as soon as it has been finalized so the
+               sync after training only has to transfer the remaining delta.
+        :param checkpoints_to_sync: Which checkpoints to sync after training: 'all' syncs the whole trial results dir and
+               'best' only syncs the best checkpoint of the result (or the latest one if the run has no checkpoint score
+               attribute) plus the files outside the checkpoint directories.
+        :param session: The RemoteSession to use for the ssh connections to the Ray worker. A new session is created if
+               none is given.
+        """
         self.driver_user = driver_user
         self.driver_private_key_file = driver_private_key_file
         self.driver_platform = sys.platform
@@ -24,14 +71,20 @@ class RsyncSyncer:
         self.worker_ssh_port = worker_ssh_port
         self.worker_platform = worker_platform
         self.trial_results_dir = trial_results_dir
+        self.max_parallel_transfers = max_parallel_transfers
+        self.stream_checkpoints_interval = stream_checkpoints_interval
+        self.checkpoint_streamer = None
+        self.checkpoints_to_sync = checkpoints_to_sync
+        self.startup_report = None  # set by initialize_ray_with_syncer()
+        if session is None:
+            session = RemoteSession(worker_user, worker_hostname, worker_ssh_port, driver_private_key_file)
+        self.session = session
 
     def sync_from_driver_to_ray_worker(self):
         """Synchronize from the local computer (driver) to the Ray worker."""
-        driver_dir = normalize_home_path_for_platform(self.trial_results_dir, self.driver_user,
-                                                      self.driver_platform)
-        worker_dir = normalize_home_path_for_platform(self.trial_results_dir, self.worker_user,
-                                                      self.worker_platform)
-        sync_cmd = f'rsync -avz -e "ssh -i {self.driver_private_key_file} -o StrictHostKeyChecking=no -o LogLevel=ERROR -p {self.worker_ssh_port}" --delete --ignore-errors {driver_dir}/ {self.worker_user}@{self.worker_hostname}:{worker_dir}/'
+        driver_dir = self._get_driver_dir()
+        worker_dir = self._get_worker_dir()
+        sync_cmd = f'rsync -avz -e "{self._get_ssh_cmd()}" --delete --ignore-errors {driver_dir}/ {self._get_worker_path(worker_dir)}/'
         logger.info(f'syncing from local computer to ray worker: {sync_cmd}')
         try:
             output = str(subprocess.check_output(sync_cmd, shell=True)).replace('\\n', '\n')
@@ -39,16 +92,216 @@ class RsyncSyncer:
         except subprocess.CalledProcessError as e:
             logger.error(f'error syncing down: {e}')
 
-    def sync_from_ray_worker_to_driver(self):
-        """Synchronize from the Ray worker to the local computer (driver)."""
-        worker_dir = normalize_home_path_for_platform(self.trial_results_dir, self.worker_user,
-                                                      self.worker_platform)
-        driver_dir = normalize_home_path_for_platform(self.trial_results_dir, self.driver_user,
-                                                      self.driver_platform)
-        sync_cmd = f'rsync -avz -e "ssh -i {self.driver_private_key_file} -o StrictHostKeyChecking=no -o LogLevel=ERROR -p {self.worker_ssh_port}" --delete --ignore-errors {self.worker_user}@{self.worker_hostname}:{worker_dir}/ {driver_dir}/'
+    def clean_ray_worker_trial_results_dir(self):
+        """
+        Empty the trial results dir on the Ray worker by renaming it to a trash directory that is deleted in the
+        background on the Ray worker, so this returns without waiting for the old trials to be deleted.
+        """
+        worker_dir = self._get_worker_dir().rstrip('/')
+        trash_dir = f'{worker_dir}{TRASH_SUFFIX}{int(time.time() * 1000)}'
+        clean_cmd = f'if [ -d {worker_dir} ]; then mv {worker_dir} {trash_dir}; fi; mkdir -p {worker_dir} && ' \
+                    f'(nohup rm -rf {worker_dir}{TRASH_SUFFIX}* < /dev/null > /dev/null 2>&1 &)'
+        logger.info(f'cleaning ray worker trial results dir: {clean_cmd}')
+        try:
+            self.session.run(clean_cmd)
+        except subprocess.CalledProcessError as e:
+            logger.error(f'error cleaning ray worker trial results dir: {e}')
+
+    def sync_from_ray_worker_to_driver(self, parallel=None):
+        """
+        Synchronize from the Ray worker to the local computer (driver).
+
+        :param parallel: Whether to split the sync into concurrent transfers. Defaults to True if max_parallel_transfers
+               is greater than 1.
+        :return: a SyncResult with the aggregate bytes transferred and the wall time of the sync.
+        """
+        if parallel is None:
+            parallel = self.max_parallel_transfers > 1
+        if parallel:
+            return self._sync_from_ray_worker_to_driver_in_parallel()
+        start_time = time.monotonic()
+        worker_dir = self._get_worker_dir()
+        driver_dir = self._get_driver_dir()
+        sync_cmd = f'rsync -avz --stats -e "{self._get_ssh_cmd()}" --delete --ignore-errors {PROTECT_FILTERS} {self._get_worker_path(worker_dir)}/ {driver_dir}/'
         logger.info(f'syncing from ray worker to local computer: {sync_cmd}')
+        bytes_transferred = self._run_sync_from_ray_worker_cmd(sync_cmd)
+        result = SyncResult(1, bytes_transferred, time.monotonic() - start_time)
+        logger.info(f'synced from ray worker to local computer: {result}')
+        return result
+
+    def _sync_from_ray_worker_to_driver_in_parallel(self):
+        """Sync each checkpoint directory in its own rsync transfer and everything else in one additional transfer."""
+        start_time = time.monotonic()
+        worker_dir = self._get_worker_dir()
+        driver_dir = self._get_driver_dir()
+        checkpoint_dirs = self._list_ray_worker_checkpoint_dirs(worker_dir)
+        # excluded paths are protected from --delete, so the checkpoint directories being synced concurrently are left alone
+        excludes = ''.join(f' --exclude="/{checkpoint_dir}/"' for checkpoint_dir in checkpoint_dirs)
+        sync_cmds = [f'rsync -avz --stats -e "{self._get_ssh_cmd()}" --delete --ignore-errors {PROTECT_FILTERS}{excludes} {self._get_worker_path(worker_dir)}/ {driver_dir}/']
+        for checkpoint_dir in checkpoint_dirs:
+            sync_cmds.append(self._get_sync_checkpoint_dir_cmd(checkpoint_dir))
+        logger.info(f'syncing from ray worker to local computer using {len(sync_cmds)} transfers '
+                    f'({self.max_parallel_transfers} at a time)')
+        with ThreadPoolExecutor(max_workers=max(1, self.max_parallel_transfers)) as executor:
+            bytes_transferred = sum(executor.map(self._run_sync_from_ray_worker_cmd, sync_cmds))
+        result = SyncResult(len(sync_cmds), bytes_transferred, time.monotonic() - start_time)
+        logger.info(f'synced from ray worker to local computer: {result}')
+        return result
+
+    def sync_result_from_ray_worker_to_driver(self, result, checkpoint_config=None):
+        """
+        Synchronize the results of a training run from the Ray worker to the local computer (driver).
+
+        :param result: The ray.air.Result of the training run.
+        :param checkpoint_config: The ray.air.CheckpointConfig of the run, used to find the best checkpoint.
+        :return: a SyncResult with the aggregate bytes transferred and the wall time of the sync.
+        """
+        if self.checkpoints_to_sync != 'best':
+            return self.sync_from_ray_worker_to_driver()
+        checkpoint_dirs = []
+        for checkpoint in get_checkpoints_to_sync(result, checkpoint_config):
+            checkpoint_dir = self._get_relative_worker_checkpoint_dir(checkpoint)
+            if checkpoint_dir is not None:
+                checkpoint_dirs.append(checkpoint_dir)
+        return self.sync_checkpoint_dirs_from_ray_worker_to_driver(checkpoint_dirs)
+
+    def sync_checkpoint_dirs_from_ray_worker_to_driver(self, checkpoint_dirs):
+        """
+        Synchronize the given checkpoint directories and the files outside all checkpoint directories (results, logs,
+        metadata) from the Ray worker to the local computer (driver).
+
+        :param checkpoint_dirs: The checkpoint directories relative to the trial results dir.
+        :return: a SyncResult with the aggregate bytes transferred and the wall time of the sync.
+        """
+        start_time = time.monotonic()
+        worker_dir = self._get_worker_dir()
+        driver_dir = self._get_driver_dir()
+        sync_cmds = [f'rsync -avz --stats -e "{self._get_ssh_cmd()}" --delete --ignore-errors {PROTECT_FILTERS} --exclude="checkpoint_*/" --exclude="checkpoint-*/" {self._get_worker_path(worker_dir)}/ {driver_dir}/']
+        for checkpoint_dir in checkpoint_dirs:
+            sync_cmds.append(self._get_sync_checkpoint_dir_cmd(checkpoint_dir))
+        logger.info(f'syncing checkpoints {checkpoint_dirs} from ray worker to local computer')
+        with ThreadPoolExecutor(max_workers=max(1, self.max_parallel_transfers)) as executor:
+            bytes_transferred = sum(executor.map(self._run_sync_from_ray_worker_cmd, sync_cmds))
+        result = SyncResult(len(sync_cmds), bytes_transferred, time.monotonic() - start_time)
+        logger.info(f'synced from ray worker to local computer: {result}')
+        return result
+
+    def _get_relative_worker_checkpoint_dir(self, checkpoint):
+        """returns the directory of the checkpoint relative to the trial results dir on the Ray worker"""
+        checkpoint_path = get_checkpoint_path(checkpoint)
+        if checkpoint_path is None:
+            logger.warning(f'unable to sync checkpoint without a local path: {checkpoint}')
+            return None
+        checkpoint_path = normalize_home_path_for_platform(checkpoint_path, self.worker_user, self.worker_platform)
+        worker_dir = self._get_worker_dir().rstrip('/')
+        if not checkpoint_path.startswith(worker_dir + '/'):
+            logger.warning(f'unable to sync checkpoint outside of {worker_dir}: {checkpoint_path}')
+            return None
+        return checkpoint_path[len(worker_dir) + 1:].rstrip('/')
+
+    def _list_ray_worker_checkpoint_dirs(self, worker_dir):
+        """returns the checkpoint directories on the Ray worker relative to worker_dir (nested checkpoints are not listed separately)"""
+        return sorted(self.get_ray_worker_checkpoint_dir_sizes(worker_dir).keys())
+
+    def get_ray_worker_checkpoint_dir_sizes(self, worker_dir=None):
+        """returns a dict mapping the checkpoint directories on the Ray worker (relative to worker_dir) to their sizes in KB"""
+        if worker_dir is None:
+            worker_dir = self._get_worker_dir()
+        list_cmd = f'cd {worker_dir} && find . -type d \\( -name \'checkpoint_*\' -o -name \'checkpoint-*\' \\) -prune -exec du -sk {{}} +'
+        try:
+            output = self.session.run(list_cmd)
+        except subprocess.CalledProcessError as e:
+            logger.error(f'error listing checkpoint directories on ray worker: {e}')
+            return {}
+        checkpoint_dir_sizes = {}
+        for line in output.splitlines():
+            size, _, checkpoint_dir = line.partition('\t')
+            if checkpoint_dir.startswith('./'):
+                checkpoint_dir_sizes[checkpoint_dir[2:]] = int(size)
+        return checkpoint_dir_sizes
+
+    def sync_checkpoint_dir_from_ray_worker_to_driver(self, checkpoint_dir):
+        """
+        Synchronize a single checkpoint directory from the Ray worker to the local computer (driver).
+
+        :param checkpoint_dir: The checkpoint directory relative to the trial results dir.
+        :return: the number of bytes transferred.
+        """
+        return self._run_sync_from_ray_worker_cmd(self._get_sync_checkpoint_dir_cmd(checkpoint_dir))
+
+    def _get_sync_checkpoint_dir_cmd(self, checkpoint_dir):
+        worker_dir = self._get_worker_dir()
+        driver_dir = self._get_driver_dir()
+        os.makedirs(f'{driver_dir}/{checkpoint_dir}', exist_ok=True)
+        return f'rsync -avz --stats -e "{self._get_ssh_cmd()}" --delete --ignore-errors {self._get_worker_path(worker_dir)}/{checkpoint_dir}/ {driver_dir}/{checkpoint_dir}/'
+
+    def start_streaming_checkpoints(self):
+        """Start pulling new checkpoints in the background while training is running (if stream_checkpoints_interval is set)."""
+        if self.stream_checkpoints_interval is None or self.checkpoint_streamer is not None:
+            return
+        self.checkpoint_streamer = CheckpointStreamer(self, self.stream_checkpoints_interval)
+        self.checkpoint_streamer.start()
+
+    def stop_streaming_checkpoints(self):
+        """Stop pulling new checkpoints in the background, waiting for any transfer in progress to finish."""
+        if self.checkpoint_streamer is None:
+            return
+        self.checkpoint_streamer.stop()
+        self.checkpoint_streamer = None
+
+    def _run_sync_from_ray_worker_cmd(self, sync_cmd):
+        """runs the rsync command and returns the number of bytes received"""
         try:
             output = str(subprocess.check_output(sync_cmd, shell=True)).replace('\\n', '\n')
             logger.info(output)
         except subprocess.CalledProcessError as e:
             logger.error(f'error syncing from ray worker to local computer: {e}')
+            return 0
+        match = re.search(r'Total bytes received: ([\d,.]+)', output)
+        if match is None:
+            return 0
+        return int(re.sub(r'\D', '', match.group(1)))
+
+    def _get_ssh_cmd(self):
+        self.session.open()
+        return self.session.get_ssh_cmd()
+
+    def _get_worker_path(self, path):
+        return self.session.get_remote_path(path)
+
+    def _get_driver_dir(self):
+        return normalize_home_path_for_platform(self.trial_results_dir, self.driver_user, self.driver_platform)
+
+    def _get_worker_dir(self):
+        return normalize_home_path_for_platform(self.trial_results_dir, self.worker_user, self.worker_platform)
+
+
+def get_checkpoints_to_sync(result, checkpoint_config=None):
+    """
+    Returns the best checkpoint of the result according to the checkpoint score attribute of the checkpoint config or
+    the latest checkpoint if there is no score attribute.
+    """
+    score_attribute = checkpoint_config is not None and checkpoint_config.checkpoint_score_attribute or None
+    if score_attribute is not None and result.best_checkpoints:
+        scored_checkpoints = [(checkpoint, metrics[score_attribute])
+                              for checkpoint, metrics in result.best_checkpoints
+                              if metrics is not None and score_attribute in metrics]
+        if len(scored_checkpoints) > 0:
+            if checkpoint_config.checkpoint_score_order == 'min':
+                return [min(scored_checkpoints, key=lambda scored_checkpoint: scored_checkpoint[1])[0]]
+            return [max(scored_checkpoints, key=lambda scored_checkpoint: scored_checkpoint[1])[0]]
+    if result.checkpoint is not None:
+        return [result.checkpoint]
+    return []
+
+
+def get_checkpoint_path(checkpoint):
+    """returns the path of a directory checkpoint on the node where it was saved or None if it has no path"""
+    for attribute in ('path', '_local_path'):
+        path = getattr(checkpoint, attribute, None)
+        if isinstance(path, str):
+            return path
+    uri = getattr(checkpoint, 'uri', None)
+    if isinstance(uri, str) and uri.startswith('file://'):
+        return uri[len('file://'):]
+    return None
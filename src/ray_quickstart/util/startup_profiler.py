@@ -0,0 +1,58 @@
+"""
+Records the wall time of each phase of the Ray initialization.
+"""
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+from ray import logger
+
+STARTUP_PROFILE_FILE_NAME = 'startup_profile.json'
+
+
+class StartupProfiler:
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.phases = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Record the wall time of the code run in the with block as the phase with the given name."""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            end_time = time.time()
+            with self.lock:
+                self.phases.append({'name': name,
+                                    'start': round(start_time - self.start_time, 3),
+                                    'duration': round(end_time - start_time, 3),
+                                    'thread': threading.current_thread().name})
+
+    def get_report(self):
+        """returns the phases sorted by start time and the total wall time since the profiler was created"""
+        with self.lock:
+            phases = sorted(self.phases, key=lambda phase: phase['start'])
+        return {'started_at': self.start_time,
+                'total_duration': round(time.time() - self.start_time, 3),
+                'phases': phases}
+
+    def write_json(self, file_path, report=None):
+        if report is None:
+            report = self.get_report()
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    def log_table(self, report=None):
+        if report is None:
+            report = self.get_report()
+        lines = [f'{"phase":<24} {"start (s)":>10} {"duration (s)":>13}']
+        for phase in report['phases']:
+            lines.append(f'{phase["name"]:<24} {phase["start"]:>10.3f} {phase["duration"]:>13.3f}')
+        lines.append(f'{"total":<24} {"":>10} {report["total_duration"]:>13.3f}')
+        logger.info('ray startup profile:\n' + '\n'.join(lines))
@@ -0,0 +1,65 @@
+"""
+Convenience functions for emptying directories without waiting for their contents to be deleted
+"""
+import errno
+import glob
+import os
+import shutil
+import threading
+import time
+
+from ray import logger
+
+TRASH_SUFFIX = '.trash-'
+
+
+def move_dir_to_trash(dir_path):
+    """
+    Atomically rename the directory to a sibling trash directory and recreate it empty. If dir_path is a symlink, the
+    directory it points to is emptied and the symlink is kept. A directory that cannot be renamed (a mount point, or a
+    directory whose parent is on another device) has its contents deleted in place instead, which blocks until they are
+    deleted.
+
+    :return: the path of the trash directory or None if the directory did not exist or was emptied in place.
+    """
+    dir_path = os.path.realpath(dir_path)
+    trash_dir_path = None
+    if os.path.exists(dir_path):
+        trash_dir_path = f'{dir_path}{TRASH_SUFFIX}{int(time.time() * 1000)}'
+        try:
+            os.rename(dir_path, trash_dir_path)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EBUSY):
+                raise
+            logger.info(f'cannot move {dir_path} to the trash ({e.strerror}): deleting its contents in place...')
+            _delete_dir_contents(dir_path)
+            trash_dir_path = None
+    os.makedirs(dir_path, exist_ok=True)
+    return trash_dir_path
+
+
+def start_trash_reaper(dir_path):
+    """
+    Delete the trash directories of dir_path (including ones left behind by earlier runs) in a background thread.
+
+    :return: the thread doing the deletion.
+    """
+    reaper = threading.Thread(target=empty_trash, args=(dir_path,), name='trash-reaper', daemon=True)
+    reaper.start()
+    return reaper
+
+
+def empty_trash(dir_path):
+    # the trash directories are next to the directory a symlink points to (see move_dir_to_trash())
+    dir_path = os.path.realpath(dir_path)
+    for trash_dir_path in glob.glob(f'{glob.escape(dir_path)}{TRASH_SUFFIX}*'):
+        logger.info(f'deleting {trash_dir_path}...')
+        shutil.rmtree(trash_dir_path, ignore_errors=True)
+
+
+def _delete_dir_contents(dir_path):
+    for entry in os.scandir(dir_path):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
@@ -0,0 +1,131 @@
+"""
+Finds the per-device batch size with the highest training throughput and the gradient accumulation that keeps the
+effective batch size of the training args.
+"""
+from contextlib import nullcontext
+import math
+import time
+
+import torch
+
+from log import log
+from util import platform
+
+PRECISION_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def probe_batch_sizes(model, device, precision=None, max_batch_size=1024, num_steps=3, min_improvement=0.05):
+    """
+    Measure the training throughput of model at batch sizes 1, 2, 4... with synthetic tokens, doing the same work as a
+    training step (forward, backward and optimizer step). The probe stops at the first batch size that runs out of
+    memory, at max_batch_size or, on the CPU, where memory rarely runs out before the batches get too slow to be
+    useful, when doubling the batch size no longer improves the throughput by min_improvement. On the CPU, the largest
+    probed batch size is therefore the one where the throughput levels off, not the largest one that fits in memory.
+
+    :param model: The HuggingFace model, which is trained by the probe and should be discarded afterwards.
+    :param precision: 'bf16' or 'fp16' to run the forward pass in mixed precision like the Trainer does with the bf16 or
+           fp16 training arg, which changes both the memory used and the throughput. Defaults to full precision.
+    :return: a dict of the batch sizes that fit in memory to their throughput in tokens per second.
+    """
+    model.to(device)
+    model.train()
+    block_size = getattr(model.config, 'block_size', model.config.n_positions)
+    optimizer = torch.optim.AdamW(model.parameters())
+    tokens_per_sec = {}
+    batch_size = 1
+    while batch_size <= max_batch_size:
+        try:
+            tokens_per_sec[batch_size] = _measure_tokens_per_sec(model, optimizer, device, precision, batch_size,
+                                                                 block_size, num_steps)
+        except RuntimeError as e:
+            if not _is_out_of_memory(e):
+                raise
+            log.info(f'batch size {batch_size}: out of memory')
+            break
+        finally:
+            optimizer.zero_grad(set_to_none=True)
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
+        log.info(f'batch size {batch_size}: {tokens_per_sec[batch_size]:.0f} tokens/s')
+        if device.type == 'cpu' and batch_size > 1 \
+                and tokens_per_sec[batch_size] < tokens_per_sec[batch_size // 2] * (1 + min_improvement):
+            break
+        batch_size *= 2
+    if len(tokens_per_sec) == 0:
+        raise RuntimeError(f'a batch of 1 example of {block_size} tokens does not fit in the memory of {device}')
+    return tokens_per_sec
+
+
+def probe_batch_sizes_for_model(config, model_class, storage_manager, model_name, pipeline_name, precision=None,
+                                **kwargs):
+    """
+    Run probe_batch_sizes() on a new model_class model, on the device of the current node. The model is created here
+    from its name, so that only the settings of the probe have to be sent to a Ray worker.
+    """
+    device = torch.device('cpu' if config.force_cpu else platform.get_device_type())
+    model = model_class(storage_manager, model_name, pipeline_name)
+    model.load_or_create_model()
+    log.info(f'probing batch sizes for {model_name} model on {device} with {precision or "full"} precision...')
+    return probe_batch_sizes(model.get_model(), device, precision, **kwargs)
+
+
+def get_precision(training_args):
+    """returns 'bf16' or 'fp16' if the training args enable mixed precision training or None"""
+    for precision in PRECISION_DTYPES:
+        if training_args.get(precision):
+            return precision
+    return None
+
+
+def choose_batch_size(tokens_per_sec, num_workers=1, target_effective_batch_size=None):
+    """
+    returns the per-device batch size with the highest throughput, capped so that it does not exceed the target
+    effective batch size across the workers, and the gradient accumulation steps needed to reach the target. On the
+    CPU, the probe stops where the throughput levels off (see probe_batch_sizes()), so the batch size is chosen among
+    the batch sizes up to that point rather than up to the largest one that fits in memory.
+    """
+    batch_size = max(tokens_per_sec, key=tokens_per_sec.get)
+    if target_effective_batch_size is None:
+        return batch_size, 1
+    while batch_size > 1 and batch_size * num_workers > target_effective_batch_size:
+        batch_size //= 2
+    gradient_accumulation_steps = max(math.ceil(target_effective_batch_size / (batch_size * num_workers)), 1)
+    effective_batch_size = batch_size * num_workers * gradient_accumulation_steps
+    if effective_batch_size != target_effective_batch_size:
+        log.warning(f'the effective batch size is {effective_batch_size} instead of {target_effective_batch_size}: '
+                    f'use a power of 2 for the target to match it exactly')
+    return batch_size, gradient_accumulation_steps
+
+
+def _measure_tokens_per_sec(model, optimizer, device, precision, batch_size, block_size, num_steps):
+    input_ids = torch.randint(0, model.config.vocab_size, (batch_size, block_size), device=device)
+    # like the Trainer, the forward pass runs under autocast and the fp16 loss is scaled on CUDA
+    autocast = precision is not None and torch.autocast(device.type, dtype=PRECISION_DTYPES[precision]) or nullcontext()
+    scaler = torch.amp.GradScaler('cuda', enabled=precision == 'fp16' and device.type == 'cuda')
+    start_time = None
+    for step in range(num_steps + 1):
+        if step == 1:
+            # the first step is a warm-up that allocates the gradients and the optimizer state
+            _synchronize(device)
+            start_time = time.perf_counter()
+        with autocast:
+            loss = model(input_ids=input_ids, labels=input_ids).loss
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad(set_to_none=True)
+    _synchronize(device)
+    return batch_size * block_size * num_steps / (time.perf_counter() - start_time)
+
+
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    elif device.type == 'mps':
+        torch.mps.synchronize()
+
+
+def _is_out_of_memory(e):
+    out_of_memory_error = getattr(torch.cuda, 'OutOfMemoryError', None)
+    return (out_of_memory_error is not None and isinstance(e, out_of_memory_error)) \
+        or 'out of memory' in str(e).lower()
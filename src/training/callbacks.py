@@ -0,0 +1,74 @@
+"""
+Trainer callbacks shared by the trainer initializers.
+"""
+import os
+
+import torch
+from transformers import TrainerCallback
+
+from log import log
+
+
+class DatasetEpochCallback(TrainerCallback):
+    """Tells the dataset which epoch is starting so it can resample its examples for the epoch."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.dataset.set_epoch(int(state.epoch or 0))
+
+
+class ProfilerCallback(TrainerCallback):
+    """
+    Profiles the training steps with torch.profiler on a wait/warmup/active schedule. The steps are delimited at the end
+    of each optimizer step, so the profiled steps include the time spent waiting for the next batch. Each completed
+    cycle writes a Chrome trace (open it in chrome://tracing or Perfetto) and a table of the most expensive operators to
+    output_dir.
+    """
+
+    def __init__(self, output_dir, wait_steps=1, warmup_steps=1, active_steps=3, repeat=1, row_limit=50):
+        self.output_dir = output_dir
+        self.wait_steps = wait_steps
+        self.warmup_steps = warmup_steps
+        self.active_steps = active_steps
+        self.repeat = repeat
+        self.row_limit = row_limit
+        self.profiler = None
+        self.process_index = 0
+        self.sort_by = 'self_cpu_time_total'
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.process_index = args.process_index
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available() and not args.no_cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.sort_by = 'self_cuda_time_total'
+        os.makedirs(self.output_dir, exist_ok=True)
+        log.info(f'profiling {self.active_steps} training steps after {self.wait_steps + self.warmup_steps} steps, '
+                 f'{self.repeat} times, to {self.output_dir}')
+        self.profiler = torch.profiler.profile(activities=activities,
+                                               schedule=torch.profiler.schedule(wait=self.wait_steps,
+                                                                                warmup=self.warmup_steps,
+                                                                                active=self.active_steps,
+                                                                                repeat=self.repeat),
+                                               on_trace_ready=self._on_trace_ready,
+                                               record_shapes=True,
+                                               profile_memory=True)
+        self.profiler.start()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self.profiler is not None:
+            self.profiler.step()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+    def _on_trace_ready(self, profiler):
+        file_path_prefix = f'{self.output_dir}/worker{self.process_index}_step{profiler.step_num}'
+        profiler.export_chrome_trace(f'{file_path_prefix}.trace.json')
+        with open(f'{file_path_prefix}.operators.txt', 'w') as f:
+            f.write(profiler.key_averages().table(sort_by=self.sort_by, row_limit=self.row_limit))
+        log.info(f'wrote profiler trace and operator table to {file_path_prefix}.*')
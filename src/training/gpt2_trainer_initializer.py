@@ -2,12 +2,16 @@
 Trainer initializer for the GPT model.
 """
 import ray
-from transformers import DefaultDataCollator
+from ray.air import session
 
 from config import config
-from data.gpt2_dataset import GPT2Dataset
+from data.cached_token_store import cache_token_store_on_cluster
+from data.gpt2_data_collator import GPT2DataCollator
+from data.gpt2_dataset import GPT2Dataset, GPT2TokenWindowDataset
+from data.token_store import TokenStore
 from models.gpt2 import GPT2
-from ray_quickstart.monkey_patch import monkey_patch_huggingface_utils_to_process_datasets_for_gpt2
+from ray_quickstart.dataset_cache import cache_array_on_cluster
+from training.callbacks import DatasetEpochCallback
 from training.huggingface_trainer_initializer_base import HuggingFaceTrainerInitializerBase
 
 
@@ -15,6 +19,8 @@ class GPT2TrainerInitializer(HuggingFaceTrainerInitializerBase):
 
     def __init__(self, storage_manager, model, env_vars):
         super().__init__(storage_manager, model, config, env_vars)
+        self.token_buffers = {}
+        self.offset_samplers = {}
 
     def get_pipeline_name(self):
         if self.model is not None:
@@ -37,11 +43,39 @@ class GPT2TrainerInitializer(HuggingFaceTrainerInitializerBase):
         return GPT2Dataset(model, is_eval=is_eval)
 
     def convert_to_ray_dataset(self, dataset):
-        return ray.data.from_numpy(dataset.get_data_for_ray_dataset())
+        # the tokens are sent to the dataset cache of the nodes (only if they are not there from an earlier run) and the
+        # Ray dataset only holds the example indices, so the data sent to the cluster is at most O(tokens) instead of
+        # O(tokens x block_size)
+        token_buffer = dataset.get_token_buffer()
+        if isinstance(token_buffer, TokenStore):
+            self.token_buffers[dataset.dataset_name] = cache_token_store_on_cluster(token_buffer)
+        else:
+            self.token_buffers[dataset.dataset_name] = cache_array_on_cluster(token_buffer)
+        self.offset_samplers[dataset.dataset_name] = dataset.offset_sampler
+        return ray.data.range(len(dataset))
 
     def data_collator_init(self, model):
-        return DefaultDataCollator()
+        return GPT2DataCollator(model.model.config.vocab_size)
+
+    def trainer_init_config_init(self, model, args, data_collator):
+        trainer_init_config = super().trainer_init_config_init(model, args, data_collator)
+        trainer_init_config['token_buffers'] = dict(self.token_buffers)
+        trainer_init_config['offset_samplers'] = dict(self.offset_samplers)
+        return trainer_init_config
 
     def trainer_init_per_worker(self, train_dataset, eval_dataset, **trainer_init_config):
-        monkey_patch_huggingface_utils_to_process_datasets_for_gpt2()
-        return super().trainer_init_per_worker(train_dataset, eval_dataset, **trainer_init_config)
+        token_buffers = trainer_init_config.pop('token_buffers', None)
+        offset_samplers = trainer_init_config.pop('offset_samplers', None)
+        if token_buffers:
+            block_size = trainer_init_config['model'].model.config.block_size
+            train_dataset = GPT2TokenWindowDataset(train_dataset, session.get_dataset_shard('train'),
+                                                   token_buffers['train'].load(), block_size,
+                                                   offset_samplers['train'])
+            eval_dataset = GPT2TokenWindowDataset(eval_dataset, session.get_dataset_shard('evaluation'),
+                                                  token_buffers['val'].load(), block_size, offset_samplers['val'])
+        trainer = super().trainer_init_per_worker(train_dataset, eval_dataset, **trainer_init_config)
+        # only the training examples vary by worker and epoch: every worker evaluates its shard of the same eval set
+        if hasattr(train_dataset, 'set_epoch'):
+            train_dataset.set_rank(trainer.args.process_index)
+            trainer.add_callback(DatasetEpochCallback(train_dataset))
+        return trainer
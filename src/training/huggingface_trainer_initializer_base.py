@@ -3,18 +3,31 @@ import logging
 import os
 
 import numpy as np
-from ray.air import CheckpointConfig, RunConfig
+from ray.air import CheckpointConfig, RunConfig, session
 from ray.train.huggingface import HuggingFaceTrainer
 from ray.train.torch import TorchConfig
-from transformers import TrainingArguments
+from torch.utils.data import IterableDataset
 import transformers.trainer
 from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
 
 from log import log, LOGS_DIR
 from ray_quickstart.util.platform import normalize_home_path_for_platform
+from training.callbacks import ProfilerCallback
+from training.timed_trainer import TimedTrainer
 from training.trainer_initializer_base import TrainerInitializerBase
+from training.training_args import create_training_args, get_training_args_fields, training_args_to_dict
 from util import platform
 
+DATALOADER_ARGS = ('dataloader_num_workers',
+                   'dataloader_prefetch_factor',
+                   'dataloader_persistent_workers',
+                   'dataloader_pin_memory')
+PROFILER_SETTINGS = ('profile_training',
+                     'profiler_wait_steps',
+                     'profiler_warmup_steps',
+                     'profiler_active_steps',
+                     'profiler_repeat')
+
 
 class HuggingFaceTrainerInitializerBase(TrainerInitializerBase, ABC):
 
@@ -28,7 +41,7 @@ class HuggingFaceTrainerInitializerBase(TrainerInitializerBase, ABC):
             load_best_model_at_end = False
         else:
             load_best_model_at_end=True
-        args = TrainingArguments(
+        base_args = dict(
             seed=self.config.seed,
             data_seed=self.config.seed,
             remove_unused_columns=True,
@@ -41,62 +54,132 @@ class HuggingFaceTrainerInitializerBase(TrainerInitializerBase, ABC):
             optim='adamw_torch',
             use_mps_device=platform.is_mac() and not self.config.get_run_on_ray_cluster() and self.config.device_type == 'mps',
             disable_tqdm=disable_tqdm,
+            **{name: getattr(self.config, name) for name in DATALOADER_ARGS},
         )
-        training_args = model.load_training_args()
-        if training_args is not None:
-            for key, value in training_args.items():
-                setattr(args, key, value)
-        return args
+        training_args = dict(model.load_training_args() or {})
+        for name in PROFILER_SETTINGS:
+            # the profiler settings are not training args: they are read by profiler_settings_init()
+            training_args.pop(name, None)
+        # the dataloader settings are checked together once train.yaml has been applied
+        dataloader_args = {name: training_args.pop(name, base_args.pop(name)) for name in DATALOADER_ARGS}
+        base_args.update(self.dataloader_args_init(dataloader_args))
+        return create_training_args(base_args, training_args, f'{model.model_name} train.yaml')
+
+    def dataloader_args_init(self, dataloader_args, train_dataset=None):
+        """
+        returns the dataloader_* training args that the installed version of transformers supports and that are valid
+        together
+        """
+        dataloader_args = dict(dataloader_args)
+        supported_args = get_training_args_fields()
+        for name in list(dataloader_args.keys()):
+            if name not in supported_args:
+                log.warning(f'{name} is not supported by the installed version of transformers: ignoring it')
+                del dataloader_args[name]
+        if isinstance(train_dataset, IterableDataset) and dataloader_args.get('dataloader_num_workers', 0) > 0:
+            # the iterable datasets are backed by the Ray dataset shard of the worker, which cannot be read from the
+            # DataLoader's worker processes: Ray prefetches their batches instead
+            log.info('loading the batches of the iterable dataset in the training process')
+            dataloader_args['dataloader_num_workers'] = 0
+        offset_sampler = getattr(train_dataset, 'offset_sampler', None)
+        if offset_sampler is not None and offset_sampler.is_resampled_per_epoch() \
+                and dataloader_args.get('dataloader_persistent_workers', False):
+            # DatasetEpochCallback only updates the dataset of the training process: the DataLoader has to copy it to
+            # new worker processes at each epoch for them to see the offsets of the epoch
+            log.info('not keeping the DataLoader workers alive between epochs since the dataset is resampled per epoch')
+            dataloader_args['dataloader_persistent_workers'] = False
+        if dataloader_args.get('dataloader_num_workers', 0) == 0:
+            # the DataLoader rejects these settings when it has no workers
+            dataloader_args.pop('dataloader_prefetch_factor', None)
+            dataloader_args.pop('dataloader_persistent_workers', None)
+        return dataloader_args
+
+    def worker_trainer_args_init(self, args, train_dataset):
+        """
+        Reinitialize the training arguments on the worker so that they get initialized correctly there. Every field of
+        args is kept: only the paths, the device and the dataloader settings are adapted to the worker.
+        """
+        args = training_args_to_dict(args)
+        overrides = {
+            'output_dir': normalize_home_path_for_platform(args['output_dir'], None, None),
+            'logging_dir': normalize_home_path_for_platform(args['logging_dir'], None, None), # logging for TensorBoard
+            'no_cuda': self.config.force_cpu,
+        }
+        overrides.update(self.dataloader_args_init({name: args.pop(name) for name in DATALOADER_ARGS if name in args},
+                                                   train_dataset))
+        return create_training_args(args, overrides, 'the Ray worker')
+
+    def profiler_settings_init(self, model):
+        """returns the profiler settings of the config with the ones in the model's train.yaml applied on top"""
+        training_args = model.load_training_args() or {}
+        return {name: training_args.get(name, getattr(self.config, name)) for name in PROFILER_SETTINGS}
+
+    def profiler_callback_init(self, profiler_settings):
+        if self.config.get_run_on_ray_cluster():
+            # the trial dir is synced back to the driver along with the checkpoints
+            output_dir = f'{session.get_trial_dir()}/profiler'
+        else:
+            output_dir = f'{LOGS_DIR}/profiler'
+        return ProfilerCallback(output_dir,
+                                wait_steps=profiler_settings['profiler_wait_steps'],
+                                warmup_steps=profiler_settings['profiler_warmup_steps'],
+                                active_steps=profiler_settings['profiler_active_steps'],
+                                repeat=profiler_settings['profiler_repeat'])
 
-    def trainer_init(self, model, args, train_dataset, eval_dataset, scaling_config):
+    def trainer_init(self, model, args, train_dataset, eval_dataset, scaling_config, checkpoints_to_sync='all',
+                     local_dir=None):
         data_collator = self.data_collator_init(model)
         trainer = HuggingFaceTrainer(
             trainer_init_per_worker=self.trainer_init_per_worker,
             scaling_config=scaling_config,
             datasets={'train': train_dataset, 'evaluation': eval_dataset},
-            trainer_init_config={'model': model,
-                                 'args': args,
-                                 'data_collator': data_collator,
-                                 'compute_metrics': self.compute_metrics_init()},
+            trainer_init_config=self.trainer_init_config_init(model, args, data_collator),
+            # gloo runs DDP on CPU-only workers as well as on GPU workers, including on Windows where nccl is missing
             torch_config=TorchConfig(backend='gloo'),
             run_config=RunConfig(name=model.model_name,
-                                 checkpoint_config=CheckpointConfig(num_to_keep=3),
+                                 local_dir=local_dir,
+                                 checkpoint_config=self.checkpoint_config_init(args, checkpoints_to_sync),
                                  log_to_file=f'{model.model_name}.log')
         )
         return trainer
 
+    def trainer_init_config_init(self, model, args, data_collator):
+        """returns the config that is passed to trainer_init_per_worker() on the Ray worker"""
+        return {'model': model,
+                'args': args,
+                'data_collator': data_collator,
+                'compute_metrics': self.compute_metrics_init(),
+                'profiler_settings': self.profiler_settings_init(model)}
+
+    def checkpoint_config_init(self, args, checkpoints_to_sync='all'):
+        """
+        When only the best checkpoint is synced, scores the checkpoints by metric_for_best_model so the syncer can tell
+        which checkpoint is the best one. Otherwise Ray keeps the latest checkpoints.
+        """
+        evaluation_strategy = getattr(args.evaluation_strategy, 'value', args.evaluation_strategy)
+        if checkpoints_to_sync != 'best' or args.metric_for_best_model is None or evaluation_strategy == 'no':
+            return CheckpointConfig(num_to_keep=3)
+        metric_for_best_model = args.metric_for_best_model
+        if not metric_for_best_model.startswith('eval_'):
+            metric_for_best_model = f'eval_{metric_for_best_model}'
+        return CheckpointConfig(num_to_keep=3,
+                                checkpoint_score_attribute=metric_for_best_model,
+                                checkpoint_score_order=args.greater_is_better is False and 'min' or 'max')
+
     def trainer_init_per_worker(self, train_dataset, eval_dataset, **trainer_init_config):
         logging.basicConfig(level=logging.INFO)
         model = 'model' in trainer_init_config and trainer_init_config['model'] or None
         model_init = 'model_init' in trainer_init_config and trainer_init_config['model_init'] or None
-        args = trainer_init_config['args']
-        # reinitialize the training arguments so that it gets initialized correctly on the worker
-        output_dir = normalize_home_path_for_platform(args.output_dir, None, None)
-        args = TrainingArguments(
-            seed=args.seed,
-            data_seed=args.seed,
-            remove_unused_columns=args.remove_unused_columns,
-            output_dir=output_dir,
-            learning_rate=args.learning_rate,
-            per_device_train_batch_size=args.per_device_train_batch_size,
-            per_device_eval_batch_size=args.per_device_eval_batch_size,
-            num_train_epochs=args.num_train_epochs,
-            weight_decay=args.weight_decay,
-            logging_dir=normalize_home_path_for_platform(args.logging_dir, None, None), # logging for TensorBoard
-            logging_strategy=args.logging_strategy,
-            evaluation_strategy=args.evaluation_strategy,
-            save_strategy=args.save_strategy,
-            load_best_model_at_end=args.load_best_model_at_end,
-            metric_for_best_model=args.metric_for_best_model,
-            optim=args.optim,
-            #max_steps=1,
-            no_cuda=self.config.force_cpu,
-            use_mps_device=args.use_mps_device,
-            disable_tqdm=args.disable_tqdm,
-        )
+        args = self.worker_trainer_args_init(trainer_init_config['args'], train_dataset)
         data_collator = trainer_init_config['data_collator']
         compute_metrics = 'compute_metrics' in trainer_init_config and trainer_init_config['compute_metrics'] or None
-        trainer = transformers.Trainer(
+        profiler_settings = trainer_init_config.get('profiler_settings')
+        if profiler_settings is None:
+            # local training does not go through trainer_init_config_init()
+            profiler_settings = model is not None and self.profiler_settings_init(model) \
+                or {name: getattr(self.config, name) for name in PROFILER_SETTINGS}
+        trainer_class = self.config.time_training_steps and TimedTrainer or transformers.Trainer
+        trainer = trainer_class(
             train_dataset=train_dataset,
             eval_dataset=eval_dataset,
             model=model,
@@ -105,6 +188,8 @@ class HuggingFaceTrainerInitializerBase(TrainerInitializerBase, ABC):
             data_collator=data_collator,
             compute_metrics=compute_metrics
         )
+        if profiler_settings['profile_training']:
+            trainer.add_callback(self.profiler_callback_init(profiler_settings))
         return trainer
 
     def update_model_with_best_checkpoint(self, model, checkpoints, default_eval_metric):
@@ -117,10 +202,16 @@ class HuggingFaceTrainerInitializerBase(TrainerInitializerBase, ABC):
             eval_metric = training_args['metric_for_best_model']
         else:
             eval_metric = default_eval_metric
+        if training_args is not None and 'greater_is_better' in training_args:
+            greater_is_better = training_args['greater_is_better']
+        else:
+            greater_is_better = not eval_metric.endswith('loss')
         for index, checkpoint_info in enumerate(checkpoints):
             checkpoint_metrics = checkpoint_info[1]
             metric_value = checkpoint_metrics[eval_metric]
-            if best_checkpoint_value is None or metric_value > best_checkpoint_value:
+            if best_checkpoint_value is None \
+                    or (greater_is_better and metric_value > best_checkpoint_value) \
+                    or (not greater_is_better and metric_value < best_checkpoint_value):
                 best_checkpoint_value = metric_value
                 best_checkpoint_index = index
         best_checkpoint = checkpoints[best_checkpoint_index][0]
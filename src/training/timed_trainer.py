@@ -0,0 +1,123 @@
+"""
+HuggingFace Trainer that breaks the time of each training step down into data wait, forward, backward, optimizer step
+and checkpoint save, and reports the breakdown with the training logs.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import time
+
+import torch
+import transformers
+from transformers import TrainerCallback
+
+STEP_PHASES = ('data_wait', 'forward', 'backward', 'optimizer')
+
+
+class TimedTrainer(transformers.Trainer):
+    """
+    The timings are aggregated over each logging interval and added to the training logs, so they go wherever the logs
+    go: TensorBoard through the TensorBoard callback and the Ray Train session metrics through Ray's report callback.
+    The logs get the mean time of each phase per optimizer step (step_*_sec), the share of the step spent waiting for
+    the data (step_data_wait_fraction: close to 1 when training is input-bound) and the time spent saving checkpoints
+    during the interval (checkpoint_save_sec).
+
+    The phases are delimited by the training_step(), compute_loss() and on_step_end() hooks:
+    - data_wait: from the end of the previous step to the start of the next micro-batch, minus the time spent on
+      evaluation and checkpoints, so it includes the DataLoader and the callbacks.
+    - forward: compute_loss().
+    - backward: the rest of training_step(), including the copy of the batch to the device.
+    - optimizer: from the end of the last micro-batch to the end of the step: gradient clipping, optimizer step,
+      learning rate scheduler step and zeroing of the gradients.
+    On GPUs the device is synchronized at each boundary so the kernels are timed in the phase that launched them, which
+    costs a little throughput.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.step_timings = defaultdict(float)
+        self.num_timed_steps = 0
+        self.last_timestamp = None
+        self.paused_time = 0.0
+        self.forward_time = 0.0
+        self.add_callback(_StepEndTimingCallback(self))
+
+    def training_step(self, model, inputs, *args, **kwargs):
+        start_time = self._get_synchronized_time()
+        if self.last_timestamp is not None:
+            self.step_timings['data_wait'] += max(start_time - self.last_timestamp - self.paused_time, 0.0)
+        self.paused_time = 0.0
+        self.forward_time = 0.0
+        loss = super().training_step(model, inputs, *args, **kwargs)
+        end_time = self._get_synchronized_time()
+        self.step_timings['forward'] += self.forward_time
+        self.step_timings['backward'] += end_time - start_time - self.forward_time
+        self.last_timestamp = end_time
+        return loss
+
+    def compute_loss(self, model, inputs, *args, **kwargs):
+        start_time = self._get_synchronized_time()
+        result = super().compute_loss(model, inputs, *args, **kwargs)
+        self.forward_time += self._get_synchronized_time() - start_time
+        return result
+
+    def record_step_end(self):
+        end_time = self._get_synchronized_time()
+        if self.last_timestamp is not None:
+            self.step_timings['optimizer'] += end_time - self.last_timestamp
+        self.last_timestamp = end_time
+        self.num_timed_steps += 1
+
+    def evaluate(self, *args, **kwargs):
+        with self._paused():
+            return super().evaluate(*args, **kwargs)
+
+    def _save_checkpoint(self, *args, **kwargs):
+        with self._paused() as timer:
+            result = super()._save_checkpoint(*args, **kwargs)
+        self.step_timings['checkpoint_save'] += timer['elapsed']
+        return result
+
+    def log(self, logs, *args, **kwargs):
+        # the training logs have the loss, unlike the evaluation logs and the summary at the end of the training
+        if 'loss' in logs and self.num_timed_steps > 0:
+            logs = {**logs, **self.pop_step_timings()}
+        super().log(logs, *args, **kwargs)
+
+    def pop_step_timings(self):
+        """returns the timings aggregated since the last call"""
+        timings = {f'step_{phase}_sec': self.step_timings[phase] / self.num_timed_steps for phase in STEP_PHASES}
+        step_time = sum(timings.values())
+        timings['step_data_wait_fraction'] = step_time > 0 and timings['step_data_wait_sec'] / step_time or 0.0
+        timings['checkpoint_save_sec'] = self.step_timings['checkpoint_save']
+        self.step_timings.clear()
+        self.num_timed_steps = 0
+        return timings
+
+    @contextmanager
+    def _paused(self):
+        """excludes the time spent in the block from the data wait of the next step"""
+        timer = {'elapsed': 0.0}
+        start_time = self._get_synchronized_time()
+        try:
+            yield timer
+        finally:
+            timer['elapsed'] = self._get_synchronized_time() - start_time
+            self.paused_time += timer['elapsed']
+
+    def _get_synchronized_time(self):
+        device = self.args.device
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        elif device.type == 'mps':
+            torch.mps.synchronize()
+        return time.perf_counter()
+
+
+class _StepEndTimingCallback(TrainerCallback):
+    """on_step_end is the only hook that runs right after the optimizer step in every version of the Trainer"""
+
+    def __init__(self, trainer):
+        self.trainer = trainer
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.trainer.record_step_end()
@@ -8,7 +8,7 @@ from config import BASE_DIR, CONFIG_DIR, SRC_DIR
 from data.dataset_util import split_dataset_random
 from log import log
 from ray_quickstart import initialize_ray, initialize_ray_with_syncer
-from util.platform import get_cpu_device_count
+from training.batch_size_finder import choose_batch_size, get_precision, probe_batch_sizes_for_model
 
 
 def train(trainer_initializer):
@@ -26,19 +26,19 @@ def train(trainer_initializer):
         log.info('training using ray cluster...')
         ray_train_dataset = trainer_initializer.convert_to_ray_dataset(train_dataset)
         ray_eval_dataset = trainer_initializer.convert_to_ray_dataset(eval_dataset)
-        scaling_config = create_scaling_config()
+        scaling_config = create_scaling_config(trainer_initializer.config)
         args = trainer_initializer.trainer_args_init(model)
         trainer = trainer_initializer.trainer_init(model,
                                                    args,
                                                    ray_train_dataset,
                                                    ray_eval_dataset,
-                                                   scaling_config)
+                                                   scaling_config,
+                                                   syncer.checkpoints_to_sync)
         result = trainer.fit(syncer)
-        checkpoint = len(result.best_checkpoints) > 0
-        if checkpoint is None:
+        if not result.best_checkpoints:
             log.info('no best checkpoint found after training using ray cluster')
         else:
-            trainer_initializer.update_model_with_best_checkpoint(model, args.metric_for_best_model, )
+            trainer_initializer.update_model_with_best_checkpoint(model, result.best_checkpoints, args.metric_for_best_model)
     else:
         log.info('training using local computer...')
         model.set_train_mode()
@@ -66,7 +66,7 @@ def tune_hyperparameters(trainer_initializer):
                                                  save_strategy='no',
                                                  evaluation_strategy=evaluation_strategy,
                                                  disable_tqdm=True)
-    scaling_config = create_scaling_config()
+    scaling_config = create_scaling_config(trainer_initializer.config)
     dataset = trainer_initializer.dataset_init(model, is_eval=False)
     train_dataset, eval_dataset = split_dataset_random(dataset, 0.9) # not using a validation dataset right now because our dataset is too small for classes
     trainer_init_config = {
@@ -76,17 +76,15 @@ def tune_hyperparameters(trainer_initializer):
         'compute_metrics': trainer_initializer.compute_metrics_init()
     }
     trainer = trainer_initializer.trainer_init_per_worker(train_dataset, eval_dataset, **trainer_init_config)
+    # the batch size is a throughput setting rather than a quality hyperparameter: it comes from the training args (see
+    # find_batch_size())
     search_space = {
         'learning_rate': ray.tune.loguniform(1e-5, 1e-3),
-        'per_device_train_batch_size': ray.tune.choice([4, 8, 16, 32]),
-        'per_device_eval_batch_size': 32,
         'num_train_epochs': ray.tune.choice([5, 6, 7, 8, 9]),
         'weight_decay': ray.tune.loguniform(1e-3, 1e-1)
     }
     num_train_epochs_search_space = {
         'learning_rate': 6e-5,
-        'per_device_train_batch_size': 32,
-        'per_device_eval_batch_size': 32,
         'num_train_epochs': ray.tune.choice([20, 25, 30, 35, 40, 45, 50]),
         'weight_decay': 1e-2
     }
@@ -106,16 +104,84 @@ def tune_hyperparameters(trainer_initializer):
     log.info(f'best trial: {best_trial}')
 
 
-def create_scaling_config():
-    use_gpu = True
-    num_trainer_cpus = 1
-    if use_gpu:
-        num_cpus = 0
-        num_gpus = 1
+def find_batch_size(trainer_initializer, target_effective_batch_size=None):
+    """
+    Probe the batch sizes that fit in memory on the device that trains the model (a Ray worker when running on the Ray
+    cluster), then write the per-device batch size with the highest throughput and the gradient accumulation steps
+    that reach the target effective batch size to the model's training args. The batch sizes are probed with the
+    mixed precision (bf16 or fp16) of the training args. On a CPU, the probe stops once doubling the batch size no
+    longer improves the throughput, so the chosen batch size is where the throughput levels off rather than the largest
+    one that fits in memory.
+
+    :param target_effective_batch_size: The number of examples per optimizer step across all the workers. Defaults to
+           the effective batch size of the current training args.
+    """
+    model = trainer_initializer.model
+    training_args = model.load_training_args() or {}
+    # the model is created by the probe, so that its weights are not sent to the Ray worker
+    probe_args = (trainer_initializer.config,
+                  type(model),
+                  trainer_initializer.storage_manager,
+                  model.model_name,
+                  trainer_initializer.get_pipeline_name(),
+                  get_precision(training_args))
+    num_workers = 1
+    if trainer_initializer.config.get_run_on_ray_cluster():
+        initialize_ray(SRC_DIR, trainer_initializer.get_env_vars(), f'{CONFIG_DIR}/ray_config.yaml')
+        scaling_config = create_scaling_config(trainer_initializer.config)
+        num_workers = scaling_config.num_workers
+        resources = scaling_config.resources_per_worker
+        probe = ray.remote(num_cpus=resources['CPU'], num_gpus=resources['GPU'])(probe_batch_sizes_for_model)
+        tokens_per_sec = ray.get(probe.remote(*probe_args))
     else:
-        num_cpus = get_cpu_device_count() - num_trainer_cpus - 1
-        num_gpus = 0
-    scaling_config = ScalingConfig(num_workers=1,
+        tokens_per_sec = probe_batch_sizes_for_model(*probe_args)
+    if target_effective_batch_size is None and 'per_device_train_batch_size' in training_args:
+        target_effective_batch_size = training_args['per_device_train_batch_size'] * num_workers \
+                                      * training_args.get('gradient_accumulation_steps', 1)
+    batch_size, gradient_accumulation_steps = choose_batch_size(tokens_per_sec, num_workers,
+                                                                target_effective_batch_size)
+    log.info(f'best batch size for {model.model_name} model: {batch_size} per device with '
+             f'{gradient_accumulation_steps} gradient accumulation steps over {num_workers} workers '
+             f'({tokens_per_sec[batch_size]:.0f} tokens/s per device)')
+    training_args['per_device_train_batch_size'] = batch_size
+    training_args['gradient_accumulation_steps'] = gradient_accumulation_steps
+    model.save_training_args(training_args)
+    return batch_size, gradient_accumulation_steps
+
+
+def create_scaling_config(config):
+    """
+    Lay out the Ray Train workers on the resources of the Ray cluster, within the limits set in config. With GPUs, there
+    is one worker per GPU by default and the CPUs are shared between the workers. On CPU-only clusters, the workers
+    run DDP over gloo and a single worker gets all the CPUs by default.
+    """
+    cluster_resources = ray.cluster_resources()
+    cluster_cpus = int(cluster_resources.get('CPU', 0))
+    cluster_gpus = int(cluster_resources.get('GPU', 0))
+    use_gpu = config.use_gpu_on_ray_cluster
+    if use_gpu is None:
+        use_gpu = cluster_gpus > 0 and not config.force_cpu
+    num_trainer_cpus = config.num_ray_trainer_cpus
+    # keep a CPU free for the Ray dataset and cache tasks
+    available_cpus = max(cluster_cpus - num_trainer_cpus - 1, 0)
+    num_workers = config.num_ray_workers
+    num_cpus = config.cpus_per_ray_worker
+    num_gpus = 0
+    if use_gpu:
+        num_gpus = config.gpus_per_ray_worker or 1
+        if num_workers is None:
+            num_workers = max(cluster_gpus // num_gpus, 1)
+    elif num_workers is None:
+        num_workers = 1 if num_cpus is None else max(available_cpus // num_cpus, 1)
+    if num_cpus is None:
+        num_cpus = max(available_cpus // num_workers, 1)
+    if num_workers * num_gpus > cluster_gpus or num_workers * num_cpus + num_trainer_cpus > cluster_cpus:
+        log.warning(f'{num_workers} workers with {num_cpus} CPUs and {num_gpus} GPUs each do not fit in the Ray '
+                    f'cluster ({cluster_cpus} CPUs, {cluster_gpus} GPUs): training will wait for the resources')
+    log.info(f'scaling: {num_workers} {use_gpu and "GPU" or "CPU"} workers with {num_cpus} CPUs and {num_gpus} GPUs '
+             f'each, trainer with {num_trainer_cpus} CPUs, on a Ray cluster with {cluster_cpus} CPUs and '
+             f'{cluster_gpus} GPUs')
+    scaling_config = ScalingConfig(num_workers=num_workers,
                                    use_gpu=use_gpu,
                                    trainer_resources={'CPU': num_trainer_cpus, 'GPU': 0},
                                    resources_per_worker={'CPU': num_cpus, 'GPU': num_gpus})
@@ -44,7 +44,7 @@ class TrainerInitializerBase(ABC):
         raise NotImplementedError('need to implement do_dataset_init()')
 
     def convert_to_ray_dataset(self, dataset):
-        return ray.data.from_items(dataset)
+        return ray.data.from_items(list(dataset))
 
     @abstractmethod
     def trainer_args_init(self, model):
@@ -64,7 +64,8 @@ class TrainerInitializerBase(ABC):
         return None
 
     @abstractmethod
-    def trainer_init(self, model, args, train_dataset, eval_dataset, scaling_config):
+    def trainer_init(self, model, args, train_dataset, eval_dataset, scaling_config, checkpoints_to_sync='all',
+                     local_dir=None):
         raise NotImplementedError('need to implement trainer_init()')
 
     @abstractmethod
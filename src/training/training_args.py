@@ -0,0 +1,61 @@
+"""
+Creation of the HuggingFace TrainingArguments from layered settings, with a report of what each layer changed.
+"""
+import dataclasses
+
+from transformers import TrainingArguments
+
+from log import log
+
+
+def get_training_args_fields():
+    """returns the names of the fields that the installed version of TrainingArguments accepts"""
+    return {field.name for field in dataclasses.fields(TrainingArguments) if field.init}
+
+
+def training_args_to_dict(args):
+    """returns the init fields of the training arguments as a plain dict that can be sent to the Ray workers"""
+    return {field.name: getattr(args, field.name) for field in dataclasses.fields(args) if field.init}
+
+
+def create_training_args(base_args, overrides=None, overrides_source='overrides'):
+    """
+    Create the training arguments from base_args with overrides applied on top, in one TrainingArguments() call so the
+    overrides are validated and post-processed like any other argument. The overridden fields and the settings that are
+    not fields of the installed TrainingArguments (and so are dropped) are logged.
+
+    :param base_args: A dict of the training arguments.
+    :param overrides: A dict of the training arguments that replace the ones in base_args.
+    :param overrides_source: Where the overrides come from, for the report.
+    """
+    fields = get_training_args_fields()
+    args = {}
+    dropped = []
+    for name, value in base_args.items():
+        if name in fields:
+            args[name] = value
+        else:
+            dropped.append(name)
+    overridden = {}
+    for name, value in (overrides or {}).items():
+        if name not in fields:
+            dropped.append(name)
+        elif name not in args or args[name] != value:
+            overridden[name] = (args.get(name), value)
+            args[name] = value
+    log_training_args_report(overridden, dropped, overrides_source)
+    return TrainingArguments(**args)
+
+
+def log_training_args_report(overridden, dropped, overrides_source):
+    lines = [f'  {name}: {_format_value(old_value)} -> {_format_value(new_value)}'
+             for name, (old_value, new_value) in sorted(overridden.items())]
+    if len(lines) > 0:
+        log.info(f'training args overridden by {overrides_source}:\n' + '\n'.join(lines))
+    if len(dropped) > 0:
+        log.warning(f'ignoring settings that are not training args of the installed version of transformers: '
+                    f'{", ".join(sorted(dropped))}')
+
+
+def _format_value(value):
+    return getattr(value, 'value', value)
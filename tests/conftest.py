@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules are imported the way main.py imports them, from the src dir
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from data.gpt2_data_collator import GPT2DataCollator  # noqa: E402
+
+VOCAB_SIZE = 65
+BLOCK_SIZE = 8
+
+
+def _get_tokens():
+    return (np.arange(4 * BLOCK_SIZE + 1) % VOCAB_SIZE).astype(np.uint16)
+
+
+def _get_example(tokens, offset):
+    return {'input_ids': tokens[offset:offset + BLOCK_SIZE], 'labels': tokens[offset + 1:offset + BLOCK_SIZE + 1]}
+
+
+@pytest.mark.parametrize('gathered', [False, True])
+def test_input_ids_are_compact_and_labels_are_int64(gathered):
+    tokens = _get_tokens()
+    examples = [_get_example(tokens, offset) for offset in (0, 8, 16)]
+    if gathered:
+        features = [{key: np.stack([example[key] for example in examples]) for key in examples[0]}]
+    else:
+        features = examples
+
+    batch = GPT2DataCollator(VOCAB_SIZE)(features)
+
+    assert batch['input_ids'].dtype == torch.int16
+    # the labels are gathered across the workers during evaluation, which gloo cannot do with int16 tensors
+    assert batch['labels'].dtype == torch.int64
+    np.testing.assert_array_equal(batch['input_ids'].numpy(), np.stack([example['input_ids'] for example in examples]))
+    np.testing.assert_array_equal(batch['labels'].numpy(), np.stack([example['labels'] for example in examples]))
+
+
+def test_without_vocab_size_input_ids_are_int64():
+    batch = GPT2DataCollator()([_get_example(_get_tokens(), 0)])
+
+    assert batch['input_ids'].dtype == torch.int64
+    assert batch['labels'].dtype == torch.int64
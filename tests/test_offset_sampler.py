@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from data.offset_sampler import OffsetSampler
+
+NUM_OFFSETS = 1000
+BLOCK_SIZE = 64
+
+
+def test_all_mode_maps_indices_to_themselves():
+    sampler = OffsetSampler(NUM_OFFSETS, BLOCK_SIZE, mode='all')
+
+    assert len(sampler) == NUM_OFFSETS
+    np.testing.assert_array_equal(sampler.get_offsets(np.arange(10)), np.arange(10))
+    assert not sampler.is_resampled_per_epoch()
+
+
+@pytest.mark.parametrize('epoch', range(5))
+def test_stride_offsets_are_in_range_and_do_not_overlap(epoch):
+    sampler = OffsetSampler(NUM_OFFSETS, BLOCK_SIZE, mode='stride', seed=1)
+    sampler.set_epoch(epoch)
+
+    offsets = sampler.get_offsets(np.arange(len(sampler)))
+
+    assert len(sampler) == NUM_OFFSETS // BLOCK_SIZE
+    assert offsets.min() >= 0 and offsets.max() < NUM_OFFSETS
+    assert np.all(np.diff(offsets) >= BLOCK_SIZE)
+
+
+def test_stride_num_samples_caps_the_windows():
+    sampler = OffsetSampler(NUM_OFFSETS, BLOCK_SIZE, mode='stride', num_samples=5)
+
+    offsets = sampler.get_offsets(np.arange(len(sampler)))
+
+    assert len(sampler) == 5
+    assert np.all(np.diff(offsets) >= BLOCK_SIZE)
+
+
+def test_random_offsets_are_in_range():
+    sampler = OffsetSampler(NUM_OFFSETS, BLOCK_SIZE, mode='random', num_samples=500)
+
+    offsets = sampler.get_offsets(np.arange(len(sampler)))
+
+    assert len(sampler) == 500
+    assert offsets.min() >= 0 and offsets.max() < NUM_OFFSETS
+
+
+@pytest.mark.parametrize('mode', ['random', 'stride'])
+def test_draws_differ_per_epoch_and_rank_and_are_reproducible(mode):
+    def get_offsets(epoch, rank):
+        sampler = OffsetSampler(NUM_OFFSETS, BLOCK_SIZE, mode=mode, num_samples=10, seed=3, rank=rank)
+        sampler.set_epoch(epoch)
+        return sampler.get_offsets(np.arange(len(sampler)))
+
+    assert not np.array_equal(get_offsets(0, 0), get_offsets(1, 0))
+    assert not np.array_equal(get_offsets(0, 0), get_offsets(0, 1))
+    np.testing.assert_array_equal(get_offsets(2, 1), get_offsets(2, 1))
+
+
+def test_set_epoch_resamples_the_offsets():
+    sampler = OffsetSampler(NUM_OFFSETS, BLOCK_SIZE, mode='random', num_samples=10)
+    epoch_0_offsets = sampler.get_offsets(np.arange(10)).copy()
+
+    sampler.set_epoch(1)
+
+    assert not np.array_equal(sampler.get_offsets(np.arange(10)), epoch_0_offsets)
+
+
+def test_invalid_settings_are_rejected():
+    with pytest.raises(ValueError):
+        OffsetSampler(NUM_OFFSETS, BLOCK_SIZE, mode='shuffle')
+    with pytest.raises(ValueError):
+        OffsetSampler(NUM_OFFSETS, BLOCK_SIZE, mode='random')
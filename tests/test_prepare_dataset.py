@@ -0,0 +1,30 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+
+from data.prepare_dataset import prepare_dataset  # noqa: E402
+from data.token_store import token_store_exists, TokenStore  # noqa: E402
+
+CORPUS = 'First Citizen:\nBefore we proceed any further, hear me speak.\n' * 20
+
+
+def test_switching_output_format_removes_the_other_outputs(tmp_path):
+    input_path = tmp_path / 'raw.txt'
+    input_path.write_text(CORPUS, encoding='utf-8')
+    output_dir = str(tmp_path / 'data')
+
+    prepare_dataset(str(input_path), output_dir, output_format='token_store', num_workers=1)
+    assert token_store_exists(output_dir, 'train') and token_store_exists(output_dir, 'val')
+    store_tokens = np.asarray(TokenStore(output_dir, 'train'))
+
+    prepare_dataset(str(input_path), output_dir, output_format='bin', num_workers=1)
+    assert not token_store_exists(output_dir, 'train') and not token_store_exists(output_dir, 'val')
+    assert not [file_name for file_name in os.listdir(output_dir) if file_name.endswith('.tokens')]
+    np.testing.assert_array_equal(np.fromfile(f'{output_dir}/train.bin', dtype=np.uint16), store_tokens)
+
+    prepare_dataset(str(input_path), output_dir, output_format='token_store', num_workers=1)
+    assert not os.path.exists(f'{output_dir}/train.bin') and not os.path.exists(f'{output_dir}/val.bin')
+    assert token_store_exists(output_dir, 'train')
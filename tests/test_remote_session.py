@@ -0,0 +1,67 @@
+import getpass
+import os
+import shlex
+import subprocess
+
+import pytest
+
+pytest.importorskip('ray')
+
+from ray_quickstart import remote_session  # noqa: E402
+from ray_quickstart.remote_session import RemoteSession  # noqa: E402
+
+# the private key used to log into the local sshd, which must accept it for the current user
+TEST_SSH_KEY = os.environ.get('RAY_QUICKSTART_TEST_SSH_KEY', '~/.ssh/id_rsa')
+TEST_SSH_PORT = int(os.environ.get('RAY_QUICKSTART_TEST_SSH_PORT', '22'))
+
+
+def can_ssh_to_localhost():
+    try:
+        result = subprocess.run(f'ssh -i {TEST_SSH_KEY} -o BatchMode=yes -o StrictHostKeyChecking=no '
+                                f'-o UserKnownHostsFile=/dev/null -o LogLevel=ERROR -o ConnectTimeout=5 -p {TEST_SSH_PORT} '
+                                f'{getpass.getuser()}@localhost true',
+                                shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL, timeout=15)
+    except subprocess.TimeoutExpired:
+        return False
+    return result.returncode == 0
+
+
+def test_known_hosts_file_is_used_for_forgetting_and_recording_host_keys(monkeypatch):
+    commands = []
+    monkeypatch.setattr(remote_session.subprocess, 'run', lambda command, **kwargs: commands.append(command))
+    session = RemoteSession('user', 'worker', 22, '~/.ssh/id_rsa', use_multiplexing=False,
+                            known_hosts_file='/tmp/known_hosts')
+
+    session.open()
+
+    assert shlex.split(commands[0]) == ['ssh-keygen', '-R', 'worker', '-f', '/tmp/known_hosts']
+    assert '-o UserKnownHostsFile=/tmp/known_hosts' in session.get_ssh_cmd()
+
+
+def test_run_passes_the_command_to_the_remote_shell_unchanged(monkeypatch):
+    commands = []
+    monkeypatch.setattr(remote_session.subprocess, 'run', lambda *args, **kwargs: None)
+    monkeypatch.setattr(remote_session.subprocess, 'check_output',
+                        lambda command, **kwargs: commands.append(command) or b'')
+    session = RemoteSession('user', 'worker', 22, '~/.ssh/id_rsa', use_multiplexing=False)
+    command = 'cd ~/base && echo "quoted $HOME" it\'s && ls \\( *'
+
+    session.run(command)
+
+    assert shlex.split(commands[0])[-1] == command
+
+
+@pytest.mark.skipif(not can_ssh_to_localhost(), reason='no sshd on localhost that accepts the test key')
+def test_shared_connection_is_faster_than_connection_per_command(tmp_path):
+    # opening the session forgets the host key of localhost: a temporary known hosts file keeps the user's one intact
+    session = RemoteSession(getpass.getuser(), 'localhost', TEST_SSH_PORT, TEST_SSH_KEY, use_multiplexing=True,
+                            known_hosts_file=str(tmp_path / 'known_hosts'))
+    try:
+        assert session.run('echo "hello world"').strip() == 'hello world'
+        timings = session.measure_connection_overhead(num_commands=3)
+    finally:
+        session.close()
+
+    assert session.use_multiplexing, 'the shared connection could not be opened'
+    assert timings['shared_connection'] < timings['connection_per_command']
@@ -0,0 +1,96 @@
+import json
+import pickle
+
+import numpy as np
+import pytest
+
+from data.token_store import convert_bin_to_token_store, gather_windows, get_index_path, HEADER_SIZE, TokenStore, \
+    TokenStoreWriter
+
+VOCAB_SIZE = 65
+SHARD_SIZE = 100
+
+
+@pytest.fixture
+def tokens():
+    return (np.arange(350) * 7 % VOCAB_SIZE).astype(np.uint16)
+
+
+@pytest.fixture
+def store_dir(tmp_path, tokens):
+    with TokenStoreWriter(str(tmp_path), 'train', VOCAB_SIZE, shard_size=SHARD_SIZE) as writer:
+        # writes that do not line up with the shards
+        writer.write(tokens[:30])
+        writer.write(tokens[30:])
+    return str(tmp_path)
+
+
+def test_round_trip(store_dir, tokens):
+    store = TokenStore(store_dir, 'train', verify=True)
+
+    assert len(store.shards) == 4
+    assert len(store) == len(tokens)
+    np.testing.assert_array_equal(np.asarray(store), tokens)
+    assert store[-1] == tokens[-1]
+
+
+@pytest.mark.parametrize('start, stop', [(0, 100), (95, 105), (90, 310), (99, 100), (100, 101), (340, 350), (7, 7)])
+def test_slices_across_shard_boundaries(store_dir, tokens, start, stop):
+    store = TokenStore(store_dir, 'train')
+
+    np.testing.assert_array_equal(store[start:stop], tokens[start:stop])
+
+
+def test_gather_across_shard_boundaries(store_dir, tokens):
+    store = TokenStore(store_dir, 'train')
+    offsets = np.array([0, 50, 90, 99, 100, 195, 250, 285])
+
+    windows = gather_windows(store, offsets, 65)
+
+    np.testing.assert_array_equal(windows, gather_windows(tokens, offsets, 65))
+
+
+def test_pickling_reopens_the_store(store_dir, tokens):
+    store = pickle.loads(pickle.dumps(TokenStore(store_dir, 'train')))
+
+    np.testing.assert_array_equal(store[95:105], tokens[95:105])
+
+
+def test_index_that_does_not_match_a_shard_header_is_rejected(store_dir):
+    index_path = get_index_path(store_dir, 'train')
+    with open(index_path) as f:
+        index = json.load(f)
+    index['shards'][1]['sha256'] = '0' * 64
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+
+    with pytest.raises(ValueError, match='does not match the index'):
+        TokenStore(store_dir, 'train')
+
+
+def test_verify_detects_corrupted_tokens(store_dir):
+    store = TokenStore(store_dir, 'train')
+    shard_path = store.shards[2].filename
+    with open(shard_path, 'r+b') as f:
+        f.seek(HEADER_SIZE + 10)
+        f.write(b'\xff\xff')
+
+    with pytest.raises(ValueError, match='checksum mismatch'):
+        TokenStore(store_dir, 'train', verify=True)
+
+
+def test_writer_rejects_tokens_outside_the_vocabulary(tmp_path):
+    with pytest.raises(ValueError):
+        with TokenStoreWriter(str(tmp_path), 'train', VOCAB_SIZE) as writer:
+            writer.write([0, VOCAB_SIZE])
+
+
+def test_convert_bin_to_token_store(tmp_path, tokens):
+    tokens.tofile(tmp_path / 'train.bin')
+    with open(tmp_path / 'meta.pkl', 'wb') as f:
+        pickle.dump({'vocab_size': VOCAB_SIZE}, f)
+
+    store = convert_bin_to_token_store(str(tmp_path / 'train.bin'), str(tmp_path / 'meta.pkl'), str(tmp_path / 'store'),
+                                       'train', shard_size=SHARD_SIZE)
+
+    np.testing.assert_array_equal(np.asarray(store), tokens)
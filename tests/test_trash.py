@@ -0,0 +1,77 @@
+import errno
+import os
+
+import pytest
+
+pytest.importorskip('ray')
+
+from ray_quickstart.util import trash  # noqa: E402
+from ray_quickstart.util.trash import empty_trash, move_dir_to_trash  # noqa: E402
+
+
+def _create_results_dir(dir_path):
+    os.makedirs(f'{dir_path}/checkpoint_000001')
+    with open(f'{dir_path}/checkpoint_000001/model.bin', 'w') as f:
+        f.write('weights')
+    with open(f'{dir_path}/result.json', 'w') as f:
+        f.write('{}')
+
+
+def test_moves_the_dir_to_the_trash(tmp_path):
+    dir_path = str(tmp_path / 'results')
+    _create_results_dir(dir_path)
+
+    trash_dir_path = move_dir_to_trash(dir_path)
+
+    assert os.listdir(dir_path) == []
+    assert sorted(os.listdir(trash_dir_path)) == ['checkpoint_000001', 'result.json']
+    empty_trash(dir_path)
+    assert not os.path.exists(trash_dir_path)
+
+
+def test_empties_the_target_of_a_symlink(tmp_path):
+    target_path = str(tmp_path / 'target')
+    _create_results_dir(target_path)
+    link_path = str(tmp_path / 'results')
+    os.symlink(target_path, link_path)
+
+    trash_dir_path = move_dir_to_trash(link_path)
+
+    assert os.path.islink(link_path) and os.path.realpath(link_path) == os.path.realpath(target_path)
+    assert os.listdir(target_path) == []
+    assert os.path.dirname(trash_dir_path) == os.path.realpath(tmp_path)
+    empty_trash(link_path)
+    assert not os.path.exists(trash_dir_path)
+
+
+@pytest.mark.parametrize('error_number', [errno.EXDEV, errno.EBUSY])
+def test_empties_the_dir_in_place_when_it_cannot_be_renamed(tmp_path, monkeypatch, error_number):
+    dir_path = str(tmp_path / 'results')
+    _create_results_dir(dir_path)
+    os.makedirs(str(tmp_path / 'other'))
+    (tmp_path / 'other' / 'keep.txt').write_text('keep')
+    os.symlink(str(tmp_path / 'other'), f'{dir_path}/link')
+
+    def rename(source, destination):
+        raise OSError(error_number, os.strerror(error_number))
+
+    monkeypatch.setattr(trash.os, 'rename', rename)
+
+    assert move_dir_to_trash(dir_path) is None
+    assert os.listdir(dir_path) == []
+    # the symlink is removed, not the directory it points to
+    assert (tmp_path / 'other' / 'keep.txt').exists()
+
+
+def test_other_rename_errors_are_raised(tmp_path, monkeypatch):
+    dir_path = str(tmp_path / 'results')
+    _create_results_dir(dir_path)
+
+    def rename(source, destination):
+        raise OSError(errno.EACCES, os.strerror(errno.EACCES))
+
+    monkeypatch.setattr(trash.os, 'rename', rename)
+
+    with pytest.raises(PermissionError):
+        move_dir_to_trash(dir_path)
+    assert os.path.exists(f'{dir_path}/result.json')